@@ -0,0 +1,97 @@
+import os
+import stat
+import sys
+import tempfile
+
+import pytest
+from sqlalchemy import event
+from sqlalchemy import inspect
+from sqlalchemy import select
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+DATA_DIR = os.environ.get("BENCH_DATA_DIR") or os.path.join(BENCHMARKS_DIR, ".data")
+N_GAMES = int(os.environ.get("BENCH_GAMES") or 20_000)
+N_PGN_GAMES = int(os.environ.get("BENCH_PGN_GAMES") or 2_000)
+SEED = int(os.environ.get("BENCH_SEED") or 0)
+WORK_DIR = tempfile.mkdtemp(prefix="dmemo-bench-")
+
+
+def engine_wrapper() -> str:
+    # python-chess starts engines from a single executable path.
+    path = os.path.join(WORK_DIR, "fake-uci")
+    with open(path, "w") as f:
+        f.write(f'#!/bin/sh\nexec "{sys.executable}" "{os.path.join(BENCHMARKS_DIR, "fake_uci.py")}" "$@"\n')
+    os.chmod(path, os.stat(path).st_mode | stat.S_IEXEC)
+    return path
+
+
+def split_part(text: str | None, separator: str, index: int) -> str | None:
+    if text is None:
+        return None
+    parts = text.split(separator)
+    return parts[index - 1] if index <= len(parts) else ""
+
+
+def add_functions(connection, _):
+    connection.create_function("split_part", 3, split_part, deterministic=True)
+
+
+def pytest_configure(config):
+    # The stand-ins are configured before dmemo is imported, its modules read the environment at import time. Test
+    # modules are only collected after this hook, dmemo is imported lazily here.
+    os.makedirs(DATA_DIR, exist_ok=True)
+    os.environ.update(
+        DATABASE_URL=os.environ.get("BENCH_DATABASE_URL") or f"sqlite:///{DATA_DIR}/games-{N_GAMES}-{SEED}.sqlite",
+        STOCKFISH_PATH=engine_wrapper(),
+        EXPLORER_CACHE_PATH=os.path.join(WORK_DIR, "explorer"),
+        EVAL_CACHE_PATH="",
+        EXPLORER_BOOK_PATH="",
+        EXPLORER_TRANSPOSITIONS="",
+        GAMES_STORAGE="",
+        SPECULATION_BUDGET="",
+        SESSION_STORE_PATH="",
+        ANALYSIS_SERVICE_ADDRESS="",
+        SLOW_REQUEST_SECONDS="",
+    )
+
+    from dmemo.db.session import engine
+
+    # The games scan relies on Postgres' split_part, SQLite gets it as a Python function.
+    if engine.dialect.name == "sqlite":
+        event.listen(engine, "connect", add_functions)
+
+
+@pytest.fixture(scope="session")
+def database() -> list[str]:
+    import synthetic
+
+    from dmemo.db.models import Game
+    from dmemo.db.session import engine
+
+    # Generated once per size and seed, a SQLite dataset is kept in BENCH_DATA_DIR for later runs.
+    if not inspect(engine).has_table(Game.__tablename__) or synthetic.count_games() != N_GAMES:
+        print(f"Generating {N_GAMES} games into {engine.url!r}...")
+        synthetic.load_games(synthetic.random_games(N_GAMES, SEED))
+    with engine.connect() as connection:
+        return list(connection.execute(select(Game.uci).order_by(Game.id).limit(500)).scalars())
+
+
+@pytest.fixture(scope="session")
+def pgn_file() -> str:
+    import synthetic
+
+    path = os.path.join(WORK_DIR, "games.pgn")
+    synthetic.write_pgn(path, synthetic.random_games(N_PGN_GAMES, SEED))
+    return path
+
+
+@pytest.fixture
+def throughput(benchmark):
+    # Items per second from the mean round time, stored with the benchmark in the JSON results.
+    def record(name: str, items: float):
+        # Nothing was timed with --benchmark-disable.
+        if benchmark.disabled or benchmark.stats is None:
+            return
+        benchmark.extra_info[name] = items / benchmark.stats.stats.mean
+
+    return record
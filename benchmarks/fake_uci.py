@@ -0,0 +1,100 @@
+import os
+import sys
+import threading
+import time
+import zlib
+
+import chess
+
+# A UCI engine with a fixed cost per depth, so engine-bound benchmarks measure the code around the engine.
+DEPTH_SECONDS = float(os.environ.get("FAKE_ENGINE_DEPTH_SECONDS") or 0.002)
+MAX_DEPTH = int(os.environ.get("FAKE_ENGINE_MAX_DEPTH") or 20)
+NODES_PER_DEPTH = 1_000
+
+
+def send(line: str):
+    sys.stdout.write(line + "\n")
+    sys.stdout.flush()
+
+
+def score(board: chess.Board, move: chess.Move) -> int:
+    return zlib.crc32(f"{board.epd()} {move.uci()}".encode()) % 200 - 100
+
+
+class FakeEngine:
+    def __init__(self):
+        self.board = chess.Board()
+        self.multi_pv = 1
+        self.stopped = threading.Event()
+        self.search_thread = None
+
+    def search(self, move_time: float | None, depth: int | None, nodes: int | None, search_moves: list[str]):
+        board = self.board.copy()
+        moves = [move for move in board.legal_moves if not search_moves or move.uci() in search_moves]
+        lines = sorted(moves, key=lambda move: -score(board, move))[: self.multi_pv]
+        max_depth = min(depth or MAX_DEPTH, nodes // NODES_PER_DEPTH if nodes else MAX_DEPTH, MAX_DEPTH)
+        deadline = time.monotonic() + move_time if move_time else None
+
+        completed = 0
+        for current in range(1, max(max_depth, 1) + 1):
+            if self.stopped.wait(DEPTH_SECONDS) or (deadline is not None and time.monotonic() > deadline):
+                break
+            completed = current
+            for rank, move in enumerate(lines, 1):
+                send(
+                    f"info depth {current} multipv {rank} score cp {score(board, move)} nodes {current * NODES_PER_DEPTH} "
+                    f"time {int(current * DEPTH_SECONDS * 1000)} pv {move.uci()}"
+                )
+        if not completed and lines:
+            send(f"info depth 1 multipv 1 score cp {score(board, lines[0])} pv {lines[0].uci()}")
+        send(f"bestmove {lines[0].uci() if lines else '0000'}")
+
+    def go(self, args: list[str]):
+        def value(name: str) -> int | None:
+            return int(args[args.index(name) + 1]) if name in args else None
+
+        move_time = value("movetime")
+        search_moves = args[args.index("searchmoves") + 1 :] if "searchmoves" in args else []
+        self.stopped.clear()
+        self.search_thread = threading.Thread(
+            target=self.search,
+            args=(move_time / 1000 if move_time else None, value("depth"), value("nodes"), search_moves),
+        )
+        self.search_thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        if self.search_thread is not None:
+            self.search_thread.join()
+            self.search_thread = None
+
+    def position(self, args: list[str]):
+        self.board = chess.Board() if args[0] == "startpos" else chess.Board(" ".join(args[1:7]))
+        if "moves" in args:
+            for move in args[args.index("moves") + 1 :]:
+                self.board.push_uci(move)
+
+    def run(self):
+        for line in sys.stdin:
+            command, *args = line.split() or [""]
+            if command == "uci":
+                send("id name FakeUCI")
+                send("option name MultiPV type spin default 1 min 1 max 500")
+                send("uciok")
+            elif command == "isready":
+                send("readyok")
+            elif command == "setoption" and args[1] == "MultiPV":
+                self.multi_pv = int(args[-1])
+            elif command == "position":
+                self.position(args)
+            elif command == "go":
+                self.go(args)
+            elif command == "stop":
+                self.stop()
+            elif command == "quit":
+                self.stop()
+                return
+
+
+if __name__ == "__main__":
+    FakeEngine().run()
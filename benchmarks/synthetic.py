@@ -0,0 +1,134 @@
+from collections import Counter
+from dataclasses import dataclass
+import itertools
+import random
+from typing import Iterator
+
+import chess
+from sqlalchemy import func
+from sqlalchemy import insert
+from sqlalchemy import select
+
+from dmemo.buckets import game_buckets
+from dmemo.db.crud import OPENING_TREE_DEPTH
+from dmemo.db.ingest import count_tree_moves
+from dmemo.db.ingest import format_movetext
+from dmemo.db.models import Base
+from dmemo.db.models import Game
+from dmemo.db.models import OpeningTree
+from dmemo.db.session import engine
+
+# Games run a few plies past the opening tree, so deeper lookups fall back to scanning the games table.
+GAME_PLIES = OPENING_TREE_DEPTH + 4
+TIME_CONTROLS = ("60+0", "180+0", "180+2", "300+0", "600+0", "900+10", "1800+0")
+RESULTS = ("1-0", "0-1", "1/2-1/2")
+INSERT_BATCH_SIZE = 10_000
+
+
+@dataclass
+class SyntheticGame:
+    moves: list[str]
+    white_elo: int
+    black_elo: int
+    time_control: str
+    result: str
+
+    @property
+    def uci(self) -> str:
+        return " ".join(self.moves)
+
+
+class MoveTree:
+    # Moves are drawn by a heavy-tailed rank, a few lines are very popular and most games leave them early, as in real play.
+    def __init__(self, rng: random.Random, skew: float = 1.2, cached_plies: int = 12):
+        self.rng = rng
+        self.skew = skew
+        self.cached_plies = cached_plies
+        self.children: dict[str, list[chess.Move]] = {}
+
+    def legal_moves(self, line: list[str], board: chess.Board) -> list[chess.Move]:
+        if len(line) >= self.cached_plies:
+            return list(board.legal_moves)
+        prefix = " ".join(line)
+        moves = self.children.get(prefix)
+        if moves is None:
+            moves = self.children[prefix] = list(board.legal_moves)
+        return moves
+
+    def random_line(self, plies: int) -> list[str]:
+        board, line = chess.Board(), []
+        for _ in range(plies):
+            moves = self.legal_moves(line, board)
+            if not moves:
+                break
+            move = moves[min(int(self.rng.paretovariate(self.skew)) - 1, len(moves) - 1)]
+            board.push(move)
+            line.append(move.uci())
+        return line
+
+
+def random_games(n_games: int, seed: int = 0, n_lines: int = 5_000) -> Iterator[SyntheticGame]:
+    # Games replay a fixed set of lines, a few of them very often, so millions of games cost no move generation.
+    rng = random.Random(seed)
+    tree = MoveTree(rng)
+    lines = [tree.random_line(GAME_PLIES) for _ in range(min(n_games, n_lines))]
+    weights = list(itertools.accumulate(1 / (rank + 1) for rank in range(len(lines))))
+    for _ in range(n_games):
+        yield SyntheticGame(
+            moves=rng.choices(lines, cum_weights=weights)[0],
+            white_elo=int(rng.gauss(1600, 350)),
+            black_elo=int(rng.gauss(1600, 350)),
+            time_control=rng.choice(TIME_CONTROLS),
+            result=rng.choice(RESULTS),
+        )
+
+
+def write_pgn(path: str, games: Iterator[SyntheticGame]) -> int:
+    n_games = 0
+    with open(path, "w", encoding="utf-8") as f:
+        for n_games, game in enumerate(games, 1):
+            board, san_moves = chess.Board(), []
+            for move in game.moves:
+                move = chess.Move.from_uci(move)
+                san_moves.append(board.san(move))
+                board.push(move)
+            f.write(
+                f'[Event "Rated game"]\n[Site "https://lichess.org/{n_games:08d}"]\n[Date "2024.01.01"]\n'
+                f'[White "white{n_games}"]\n[Black "black{n_games}"]\n[Result "{game.result}"]\n'
+                f'[WhiteElo "{game.white_elo}"]\n[BlackElo "{game.black_elo}"]\n[TimeControl "{game.time_control}"]\n\n'
+                f"{format_movetext(san_moves)} {game.result}\n\n"
+            )
+    return n_games
+
+
+def count_games() -> int:
+    with engine.connect() as connection:
+        return connection.execute(select(func.count()).select_from(Game)).scalar()
+
+
+def load_games(games: Iterator[SyntheticGame]):
+    # Fresh tables, the tree counts are complete before they are written, so plain inserts do on any database.
+    Base.metadata.drop_all(engine, tables=[Game.__table__, OpeningTree.__table__])
+    Base.metadata.create_all(engine, tables=[Game.__table__, OpeningTree.__table__])
+
+    tree_counts = Counter()
+    with engine.begin() as connection:
+        for batch in itertools.batched(games, INSERT_BATCH_SIZE):
+            rows = []
+            for game in batch:
+                buckets = game_buckets(game.white_elo, game.black_elo, game.time_control)
+                count_tree_moves(game.uci, OPENING_TREE_DEPTH, tree_counts, buckets)
+                rows.append(
+                    dict(
+                        uci=game.uci,
+                        white_elo=game.white_elo,
+                        black_elo=game.black_elo,
+                        time_control=game.time_control,
+                        result=game.result,
+                    )
+                )
+            connection.execute(insert(Game), rows)
+
+        rows = [dict(parent=parent, bucket=bucket, move=move, count=count) for (parent, bucket, move), count in tree_counts.items()]
+        for i in range(0, len(rows), INSERT_BATCH_SIZE):
+            connection.execute(insert(OpeningTree), rows[i : i + INSERT_BATCH_SIZE])
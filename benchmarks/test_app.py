@@ -0,0 +1,58 @@
+import chess
+import pytest
+
+from dmemo.app import create_app
+
+COLD_ROUNDS = 20
+
+
+def pgn(uci: str) -> str:
+    board = chess.Board()
+    return board.variation_san([chess.Move.from_uci(move) for move in uci.split()])
+
+
+@pytest.fixture(scope="module")
+def app(database):
+    app = create_app()
+    yield app
+    app.explorer.shutdown()
+    app.pool.shutdown()
+
+
+def move_request(uci: str, training_move: int) -> dict:
+    # White to play, so the opponent answers the last move of an odd length line.
+    return {
+        "pgn": pgn(uci),
+        "orientation": "white",
+        "engine_type": "stockfish",
+        "move_time": 0.1,
+        "training_move": training_move,
+    }
+
+
+def bot_lines(lines: list[str], plies: int) -> list[str]:
+    return sorted({" ".join(line.split()[:plies]) for line in lines})
+
+
+@pytest.mark.parametrize("training_move, plies", [(1, 5), (3, 9)], ids=["explorer-only", "with-hints"])
+def test_make_move(benchmark, app, database, training_move, plies):
+    # A new position every round: explorer and engine run cold.
+    requests = iter([move_request(uci, training_move) for uci in bot_lines(database, plies)])
+    client = app.test_client()
+
+    def setup():
+        return ("/make_move",), {"json": next(requests)}
+
+    response = benchmark.pedantic(client.post, setup=setup, rounds=COLD_ROUNDS)
+
+    assert response.status_code == 200
+
+
+def test_make_move_repeated(benchmark, app, database):
+    # The same position every round: explorer and eval cache answer.
+    request = move_request(bot_lines(database, 7)[0], 3)
+    client = app.test_client()
+
+    response = benchmark(lambda: client.post("/make_move", json=request))
+
+    assert response.status_code == 200
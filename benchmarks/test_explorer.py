@@ -0,0 +1,75 @@
+import itertools
+import os
+
+import pytest
+
+from dmemo.buckets import select_buckets
+from dmemo.db import crud
+from dmemo.explorer import Explorer
+from dmemo.utils import sample_move
+
+BUCKETS = select_buckets(1600, 2000, ["blitz", "rapid"])
+
+
+def prefixes(lines: list[str], plies: int) -> list[str]:
+    return sorted({" ".join(line.split()[:plies]) for line in lines})
+
+
+@pytest.fixture
+def explorer(tmp_path):
+    explorer = Explorer(os.fspath(tmp_path / "explorer"))
+    yield explorer
+    explorer.shutdown()
+
+
+@pytest.mark.parametrize("plies", [0, 4, 12])
+@pytest.mark.parametrize("buckets", [None, BUCKETS], ids=["all", "buckets"])
+def test_tree_distribution(benchmark, database, plies, buckets):
+    ucis = itertools.cycle(prefixes(database, plies))
+
+    distribution = benchmark(lambda: crud.get_next_move_distribution(next(ucis), buckets))
+
+    assert buckets is not None or distribution
+
+
+def test_games_distribution(benchmark, database):
+    # Past the opening tree the next move is counted from the games table.
+    ucis = itertools.cycle(prefixes(database, crud.OPENING_TREE_DEPTH + 1))
+
+    distribution = benchmark(lambda: crud.get_next_move_distribution(next(ucis)))
+
+    assert distribution
+
+
+def test_batched_distributions(benchmark, throughput, database):
+    ucis = prefixes(database, 6)[:64]
+
+    distributions = benchmark(crud.get_next_move_distributions, ucis)
+
+    assert len(distributions) == len(ucis)
+    throughput("positions_per_second", len(ucis))
+
+
+def test_explorer_hit(benchmark, database, explorer):
+    ucis = prefixes(database, 8)
+    for uci in ucis:
+        explorer.submit_and_get(uci)
+    cycle = itertools.cycle(ucis)
+
+    assert benchmark(lambda: explorer.submit_and_get(next(cycle)))
+
+
+def test_explorer_miss(benchmark, database, explorer):
+    uci = prefixes(database, 8)[0]
+
+    def setup():
+        explorer.cache.clear()
+        return (uci,), {}
+
+    assert benchmark.pedantic(explorer.submit_and_get, setup=setup, rounds=100)
+
+
+def test_sample_move(benchmark, database):
+    distribution = crud.get_next_move_distribution("")
+
+    assert benchmark(sample_move, distribution)[0] in distribution
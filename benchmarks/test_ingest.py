@@ -0,0 +1,35 @@
+import os
+
+import pytest
+
+from dmemo.db.ingest import IngestOptions
+from dmemo.db.ingest import find_game_chunks
+from dmemo.db.ingest import process_chunk
+
+CHUNK_SIZE = 256 * 1024
+
+
+def test_find_game_chunks(benchmark, throughput, pgn_file):
+    chunks = benchmark(lambda: list(find_game_chunks(pgn_file, CHUNK_SIZE)))
+
+    assert chunks[-1][1] == os.path.getsize(pgn_file)
+    throughput("megabytes_per_second", os.path.getsize(pgn_file) / 1e6)
+
+
+@pytest.mark.parametrize(
+    "options",
+    [
+        IngestOptions(fast=True),
+        IngestOptions(fast=False),
+        IngestOptions(fast=True, transpositions=True),
+        IngestOptions(fast=True, bulk=True),
+    ],
+    ids=["fast", "full-parser", "transpositions", "bulk"],
+)
+def test_process_chunk(benchmark, throughput, pgn_file, options):
+    positions = next(find_game_chunks(pgn_file, CHUNK_SIZE))
+
+    result = benchmark(process_chunk, pgn_file, options, positions)
+
+    assert result.n_games > 0
+    throughput("games_per_second", result.n_games)
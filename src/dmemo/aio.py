@@ -0,0 +1,460 @@
+import asyncio
+import os
+import time
+from typing import AsyncIterator
+from typing import Dict
+from typing import Tuple
+
+import chess
+import chess.engine
+import diskcache as dc
+
+from dmemo.db import aio as aio_crud
+from dmemo.engine import ENGINES
+from dmemo.engine import ChessAnalysisPool
+from dmemo.engine import engine_options
+from dmemo.eval import Evaluator
+from dmemo.evalcache import EvalCache
+from dmemo.explorer import cache_key
+from dmemo.explorer import use_positions
+from dmemo.jobs import JobRegistry
+from dmemo.jobs import Progress
+from dmemo.limits import AnalysisLimit
+from dmemo.limits import StabilityTracker
+from dmemo.metrics import record_span
+from dmemo.metrics import span
+from dmemo.openingbook import OpeningBook
+from dmemo.utils import position_key
+from dmemo.utils import uci2board
+
+
+class AsyncProgress(Progress):
+    # Progress a coroutine can wait on. Jobs publish from the event loop, so an asyncio.Event is enough to wake waiters.
+    def __init__(self):
+        super().__init__()
+        self._event = asyncio.Event()
+
+    def publish(self, snapshot) -> bool:
+        running = super().publish(snapshot)
+        self._event.set()
+        return running
+
+    def finish(self):
+        super().finish()
+        self._event.set()
+
+    def stop(self):
+        super().stop()
+        self._event.set()
+
+    async def wait_async(self, after: int, timeout: float) -> tuple[int, list[dict] | None]:
+        if self.version <= after and not self.done and not self.stopped:
+            self._event.clear()
+            try:
+                await asyncio.wait_for(self._event.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+        return self.version, self.snapshot
+
+
+async def analyze(
+    protocol: chess.engine.Protocol,
+    board: chess.Board,
+    limit: AnalysisLimit,
+    multi_pv: int,
+    new_game: bool = True,
+    root_moves: list[str] | None = None,
+    progress: Progress | None = None,
+) -> list[dict]:
+    # Coroutine twin of Engine.analyze.
+    game = object() if new_game else None
+    root_moves = [chess.Move.from_uci(move) for move in root_moves] if root_moves else None
+    if limit.stable_depths or progress is not None:
+        tracker = StabilityTracker(limit.stable_depths) if limit.stable_depths else None
+        with await protocol.analysis(board, limit.engine_limit(), multipv=multi_pv, game=game, root_moves=root_moves) as analysis:
+            async for info in analysis:
+                if tracker is not None and info.get("multipv", 1) == 1 and tracker.update(info):
+                    analysis.stop()
+                # Released or dropped jobs are stopped here, the task itself is never cancelled.
+                if progress is not None and progress.stopped:
+                    analysis.stop()
+                # A depth is complete once its last line arrived, same as Engine.analyze.
+                elif progress is not None and "pv" in info and info.get("multipv", 1) == len(analysis.multipv):
+                    if not progress.publish([dict(line) for line in analysis.multipv]):
+                        analysis.stop()
+            await analysis.wait()
+            return analysis.multipv
+
+    return await protocol.analyse(board, limit.engine_limit(), multipv=multi_pv, game=game, root_moves=root_moves)
+
+
+class AsyncEnginePool:
+    # A fixed set of engine processes driven from the event loop, a search does not hold a thread.
+    def __init__(self, engine_type: str, size: int, options: dict | None = None):
+        if engine_type not in ENGINES:
+            raise ValueError(f"Unknown engine type: {engine_type}")
+        if size <= 0:
+            raise ValueError("Engine pool size must be a positive integer.")
+
+        self.engine_type = engine_type
+        self.size = size
+        self.options = options
+
+        self._idle: asyncio.LifoQueue[chess.engine.Protocol] = asyncio.LifoQueue()
+        self._spawned = 0
+
+        self.checkouts = 0
+        self.restarts = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+
+    async def _spawn(self) -> chess.engine.Protocol:
+        # Also on cancellation, e.g. a request that goes away during a slow weights load, the slot and process are freed.
+        transport = None
+        try:
+            transport, protocol = await chess.engine.popen_uci(ENGINES[self.engine_type].default_path())
+            options = engine_options(self.engine_type, self.options)
+            if options:
+                await protocol.configure(options)
+            return protocol
+        except BaseException:
+            self._spawned -= 1
+            if transport is not None:
+                transport.close()
+            raise
+
+    async def checkout(self) -> chess.engine.Protocol:
+        start = time.perf_counter()
+        if self._idle.empty() and self._spawned < self.size:
+            self._spawned += 1
+            protocol = await self._spawn()
+        else:
+            protocol = await self._idle.get()
+
+        wait = time.perf_counter() - start
+        record_span("engine_checkout", wait, start)
+        self.checkouts += 1
+        self.wait_total += wait
+        self.wait_max = max(self.wait_max, wait)
+        return protocol
+
+    def checkin(self, protocol: chess.engine.Protocol):
+        self._idle.put_nowait(protocol)
+
+    async def discard(self, protocol: chess.engine.Protocol):
+        # The slot is freed, a fresh engine is spawned at a later checkout.
+        try:
+            await protocol.quit()
+        except (chess.engine.EngineError, chess.engine.EngineTerminatedError):
+            pass
+        self._spawned -= 1
+
+    async def restart(self, protocol: chess.engine.Protocol) -> chess.engine.Protocol:
+        try:
+            await protocol.quit()
+        except (chess.engine.EngineError, chess.engine.EngineTerminatedError):
+            pass
+        except BaseException:
+            self._spawned -= 1
+            raise
+        self.restarts += 1
+        return await self._spawn()
+
+    def metrics(self) -> dict:
+        return {
+            "size": self.size,
+            "spawned": self._spawned,
+            "idle": self._idle.qsize(),
+            "busy": self._spawned - self._idle.qsize(),
+            "checkouts": self.checkouts,
+            "restarts": self.restarts,
+            "wait_total": self.wait_total,
+            "wait_max": self.wait_max,
+            "wait_avg": self.wait_total / self.checkouts if self.checkouts else 0.0,
+        }
+
+    async def close(self):
+        while not self._idle.empty():
+            protocol = self._idle.get_nowait()
+            try:
+                await protocol.quit()
+            except (chess.engine.EngineError, chess.engine.EngineTerminatedError):
+                pass
+            self._spawned -= 1
+
+
+class AsyncAnalysisPool:
+    # Same jobs, ids and eval cache as ChessAnalysisPool, but each job is a task on the event loop. Any number of
+    # requests can wait on it while the engine processes bound the number of searches.
+    job_id = staticmethod(ChessAnalysisPool.job_id)
+
+    def __init__(
+        self,
+        num_engines: int = 6,
+        engine_options: Dict[str, dict] | None = None,
+        new_game: bool = True,
+        eval_cache: EvalCache | None = None,
+        job_ttl: float = 300.0,
+        max_jobs: int = 1024,
+    ):
+        if num_engines <= 0:
+            raise ValueError("Number of engines must be a positive integer.")
+
+        self.num_engines = num_engines
+        self.engine_options = engine_options or {}
+        self.new_game = new_game
+        self.eval_cache = eval_cache
+
+        self._jobs = JobRegistry(ttl=job_ttl, max_jobs=max_jobs)
+        self._engine_pools: Dict[str, AsyncEnginePool] = {}
+        print(f"♟️ Async Chess Analysis Pool initialized with {num_engines} engines.")
+
+    def engine_pool(self, engine_type: str) -> AsyncEnginePool:
+        if engine_type not in self._engine_pools:
+            self._engine_pools[engine_type] = AsyncEnginePool(
+                engine_type,
+                size=self.num_engines,
+                options=self.engine_options.get(engine_type),
+            )
+        return self._engine_pools[engine_type]
+
+    async def _run_analysis(
+        self,
+        uci: str,
+        engine_type: str,
+        limit: AnalysisLimit,
+        multi_pv: int,
+        root_moves: list[str] | None = None,
+        board: chess.Board | None = None,
+        progress: Progress | None = None,
+    ) -> list[dict]:
+        board = board if board is not None else uci2board(uci)
+        if self.eval_cache is None:
+            return await self._run_engine(board, engine_type, limit, multi_pv, root_moves, progress)
+
+        options = engine_options(engine_type, self.engine_options.get(engine_type))
+        key = self.eval_cache.key(board, engine_type, options, root_moves)
+        cached = self.eval_cache.get(key, multi_pv, limit)
+        if cached is not None:
+            return cached
+
+        engine_moves = await self._run_engine(board, engine_type, limit, multi_pv, root_moves, progress)
+        # A stopped search fell short of its limit.
+        if progress is None or not progress.stopped:
+            self.eval_cache.put(key, engine_moves, multi_pv, limit)
+        return engine_moves
+
+    async def _run_engine(
+        self,
+        board: chess.Board,
+        engine_type: str,
+        limit: AnalysisLimit,
+        multi_pv: int,
+        root_moves: list[str] | None = None,
+        progress: Progress | None = None,
+    ) -> list[dict]:
+        engine_pool = self.engine_pool(engine_type)
+        protocol = await engine_pool.checkout()
+        if progress is not None:
+            progress.start()
+        try:
+            with span("engine_search"):
+                return await analyze(protocol, board, limit, multi_pv, new_game=self.new_game, root_moves=root_moves, progress=progress)
+        except (chess.engine.EngineError, chess.engine.EngineTerminatedError):
+            print(f"💥 {engine_type} engine crashed while analysing {board.fen()!r}, restarting.")
+            crashed, protocol = protocol, None
+            protocol = await engine_pool.restart(crashed)
+            try:
+                return await analyze(protocol, board, limit, multi_pv, new_game=True, root_moves=root_moves, progress=progress)
+            except (chess.engine.EngineError, chess.engine.EngineTerminatedError):
+                # Crashed again on a fresh process, the engine is not put back into rotation.
+                broken, protocol = protocol, None
+                await engine_pool.discard(broken)
+                raise
+        finally:
+            if protocol is not None:
+                engine_pool.checkin(protocol)
+
+    def submit_job(
+        self,
+        uci: str,
+        engine_type: str,
+        limit: AnalysisLimit | float,
+        multi_pv: int,
+        speculative: bool = False,
+        root_moves: list[str] | None = None,
+        group: str | None = None,
+        board: chess.Board | None = None,
+    ) -> str:
+        # Called from the event loop, the search starts as a task right away.
+        limit = AnalysisLimit.of(limit)
+        id = self.job_id(uci, engine_type, multi_pv, root_moves, limit)
+        progress = AsyncProgress()
+
+        def start() -> asyncio.Future:
+            task = asyncio.ensure_future(self._run_analysis(uci, engine_type, limit, multi_pv, root_moves, board, progress))
+            task.add_done_callback(lambda _: progress.finish())
+            return task
+
+        reused = self._jobs.submit(id, start, speculative=speculative, group=group, progress=progress)
+        if reused:
+            print(f"Job for {uci} already submitted. Reusing job.")
+        else:
+            print(f"Job {uci} is submitted.")
+
+        return id
+
+    async def get_result(self, id: str) -> list[dict]:
+        try:
+            task = self._jobs.claim(id)
+        except KeyError:
+            raise KeyError(f"Job ID '{id}' not found or already retrieved.") from None
+
+        # A request that goes away must not cancel a search other requests may share.
+        return await asyncio.shield(task)
+
+    async def progress(self, id: str, after: int = 0, timeout: float = 1.0) -> tuple[int, list[dict] | None, bool]:
+        # Waits for lines newer than version `after` without claiming the job: (version, lines, done).
+        job = self._jobs.get(id)
+        if job is None:
+            raise KeyError(f"Job ID '{id}' not found or already retrieved.")
+        version, lines = await job.progress.wait_async(after, timeout)
+        return version, lines, job.future.done()
+
+    def cancel_job(self, id: str) -> bool:
+        return self._jobs.cancel(id)
+
+    def release_job(self, id: str) -> bool:
+        return self._jobs.release(id)
+
+    def cancel_group(self, group: str, keep: tuple[str, ...] = ()) -> int:
+        return self._jobs.cancel_group(group, keep)
+
+    def metrics(self) -> dict[str, dict]:
+        metrics = {engine_type: engine_pool.metrics() for engine_type, engine_pool in self._engine_pools.items()}
+        metrics["jobs"] = self._jobs.metrics()
+        if self.eval_cache is not None:
+            metrics["eval_cache"] = self.eval_cache.metrics()
+        return metrics
+
+    async def submit_and_get(self, uci: str, engine_type: str, limit: AnalysisLimit | float, multi_pv: int) -> list[dict]:
+        id = self.submit_job(uci, engine_type=engine_type, limit=limit, multi_pv=multi_pv)
+        return await self.get_result(id)
+
+    async def close(self):
+        self._jobs.clear()
+        for engine_pool in self._engine_pools.values():
+            await engine_pool.close()
+        if self.eval_cache is not None:
+            self.eval_cache.close()
+
+
+class AsyncExplorer:
+    # Explorer lookups as tasks: same cache keys, cache and book, misses go to the database through the async driver.
+    def __init__(
+        self,
+        cache_path: str,
+        transpositions: bool = False,
+        book_path: str | None = None,
+        job_ttl: float = 300.0,
+        max_jobs: int = 1024,
+    ):
+        self.cache = dc.Cache(cache_path)
+        self.jobs = JobRegistry(ttl=job_ttl, max_jobs=max_jobs)
+        self.transpositions = transpositions
+        self.book = OpeningBook(book_path) if book_path and os.path.exists(book_path) else None
+        self.lookups = {"book_hits": 0, "cache_hits": 0, "misses": 0}
+
+    async def _lookup(self, uci: str, buckets: tuple[int, ...] | None = None, board: chess.Board | None = None) -> dict[str, int]:
+        if self.book is not None and buckets is None and use_positions(uci, self.transpositions):
+            board = board if board is not None else uci2board(uci)
+            moves = self.book.get(board)
+        else:
+            moves = None
+        key = cache_key(uci, buckets, board, self.transpositions)
+        if moves:
+            hit = "book_hits"
+        else:
+            moves = self.cache.get(key)
+            hit = "cache_hits" if moves is not None else "misses"
+        self.lookups[hit] += 1
+        if moves is not None:
+            return moves
+
+        if use_positions(uci, self.transpositions):
+            parent_hash = position_key(board if board is not None else uci2board(uci))
+            moves = (await aio_crud.get_position_move_distributions([parent_hash], buckets))[parent_hash]
+        else:
+            moves = await aio_crud.get_next_move_distribution(uci, buckets)
+        try:
+            self.cache[key] = moves
+        except Exception as e:
+            print(f"Writing the explorer cache failed: {e}")
+        return moves
+
+    def submit_job(
+        self,
+        uci: str,
+        buckets: tuple[int, ...] | None = None,
+        speculative: bool = False,
+        board: chess.Board | None = None,
+    ) -> None:
+        self.jobs.submit((uci, buckets), lambda: asyncio.ensure_future(self._lookup(uci, buckets, board)), speculative=speculative)
+
+    async def get_result(self, uci: str, buckets: tuple[int, ...] | None = None) -> dict[str, int]:
+        try:
+            task = self.jobs.claim((uci, buckets))
+        except KeyError:
+            raise KeyError(f"UCI '{uci}' not found or already retrieved.") from None
+        return await asyncio.shield(task)
+
+    async def submit_and_get(self, uci: str, buckets: tuple[int, ...] | None = None, board: chess.Board | None = None) -> dict[str, int]:
+        self.submit_job(uci, buckets, board=board)
+        return await self.get_result(uci, buckets)
+
+    def metrics(self) -> dict:
+        hits = self.lookups["book_hits"] + self.lookups["cache_hits"]
+        total = hits + self.lookups["misses"]
+        return {
+            "lookups": dict(self.lookups),
+            "hit_ratio": hits / total if total else 0.0,
+            "jobs": self.jobs.metrics(),
+        }
+
+    def close(self):
+        self.jobs.clear()
+        self.cache.close()
+        if self.book is not None:
+            self.book.close()
+
+
+class AsyncEvaluator(Evaluator):
+    # Submitting works unchanged on AsyncAnalysisPool, only waiting for results is a coroutine.
+    async def move_score(self, best_moves: list[dict]) -> float:
+        score = self.hinted_score(best_moves)
+        if score is not None:
+            return score
+        self.submit_move_job()
+        return (await self.pool.get_result(self.claim("move_id")))[0]["score"].pov(self.pov).score()
+
+    async def updates(self, timeout: float = 1.0) -> AsyncIterator[tuple[int | None, float | None, list[tuple[str, float]]]]:
+        # Coroutine twin of Evaluator.updates.
+        seen = 0
+        while True:
+            version, lines, done = await self.pool.progress(self.best_moves_id, seen, timeout)
+            lines = [line for line in lines or [] if line.get("pv") and line.get("score") is not None]
+            if version > seen and lines:
+                seen = version
+                hints = self.hints(lines)
+                yield lines[0].get("depth"), dict(hints).get(self.move), hints
+            if done:
+                return
+
+    async def result(self) -> Tuple[float, list[tuple[str, float]]]:
+        with span("evaluator"):
+            best_moves = await self.pool.get_result(self.claim("best_moves_id"))
+
+            prev_score = best_moves[0]["score"].pov(self.pov).score()
+            curr_score = await self.move_score(best_moves)
+
+        return min(curr_score - prev_score, 0), self.hints(best_moves)
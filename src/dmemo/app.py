@@ -1,18 +1,39 @@
+from concurrent.futures import ThreadPoolExecutor
+import itertools
+import json
 import os
+from typing import Callable
+from typing import Iterator
 
 import chess
 from dotenv import load_dotenv
 from flask import Flask
+from flask import Response
+from flask import g
+from flask import jsonify
 from flask import render_template
+from flask import request
+from flask import stream_with_context
 from flask_pydantic import validate
 
+from dmemo import metrics
 from dmemo.db.session import init_db
 from dmemo.engine import ChessAnalysisPool
 from dmemo.eval import Evaluator
+from dmemo.eval import speculation_group
+from dmemo.evalcache import EvalCache
 from dmemo.explorer import Explorer
+from dmemo.limits import AnalysisLimit
 from dmemo.protocol import MoveRequest
-from dmemo.utils import pgn2board
-from dmemo.utils import pgn2uci
+from dmemo.protocol import SessionMoveRequest
+from dmemo.protocol import SessionRequest
+from dmemo.service import RemoteAnalysisPool
+from dmemo.service import RemoteExplorer
+from dmemo.service import service_authkey
+from dmemo.training import SessionConflict
+from dmemo.training import SessionStore
+from dmemo.training import TrainingSession
+from dmemo.utils import Position
 from dmemo.utils import sample_move
 
 load_dotenv()
@@ -21,17 +42,57 @@ load_dotenv()
 def create_app():
     app = Flask(__name__)
 
-    app.pool = ChessAnalysisPool(
-        num_workers=6,
-    )
-    app.explorer = Explorer(os.environ.get("EXPLORER_CACHE_PATH"), num_workers=4)
+    service_address = os.environ.get("ANALYSIS_SERVICE_ADDRESS")
+    if service_address:
+        app.pool = RemoteAnalysisPool(service_address, authkey=service_authkey())
+        app.explorer = RemoteExplorer(service_address, authkey=service_authkey())
+    else:
+        app.pool = ChessAnalysisPool(
+            num_workers=6,
+            eval_cache=EvalCache(os.environ.get("EVAL_CACHE_PATH")),
+        )
+        app.explorer = Explorer(
+            os.environ.get("EXPLORER_CACHE_PATH"),
+            num_workers=4,
+            transpositions=os.environ.get("EXPLORER_TRANSPOSITIONS") == "1",
+            book_path=os.environ.get("EXPLORER_BOOK_PATH"),
+        )
 
     app.MIN_OCCURRENCES = 10
     app.SAMPLE_THRESHOLD = 0.05
     app.N_HINTS = 3
+    # Engine seconds per move spent on analysing likely player replies before they are played, 0 disables it.
+    app.SPECULATION_BUDGET = float(os.environ.get("SPECULATION_BUDGET") or 0)
+    app.speculator = ThreadPoolExecutor(max_workers=2, thread_name_prefix="Speculator")
+    # Training sessions keep the game on the server, a shared path lets several worker processes serve the same session.
+    app.sessions = SessionStore(
+        os.environ.get("SESSION_STORE_PATH"),
+        ttl=float(os.environ.get("SESSION_TTL") or 1800),
+    )
+    app.PREFETCH_REPLIES = 3
 
     init_db()
 
+    def pool_gauges():
+        for section, values in app.pool.metrics().items():
+            if section in ("jobs", "eval_cache", "queue"):
+                yield from metrics.gauges(f"dmemo_pool_{section}", values)
+            else:
+                yield from metrics.gauges("dmemo_engine", values, engine=section)
+
+    metrics.add_gauges("pool", pool_gauges)
+    metrics.add_gauges("explorer", lambda: metrics.gauges("dmemo_explorer", app.explorer.metrics()))
+
+    @app.before_request
+    def start_trace():
+        g.trace = metrics.start_trace(f"{request.method} {request.path}")
+
+    @app.teardown_request
+    def finish_trace(_):
+        trace = g.pop("trace", None)
+        if trace is not None:
+            metrics.finish_trace(trace, request.url_rule.rule if request.url_rule else "unmatched")
+
     def make_move_response(
         sample_move: str,
         best_prev_moves: list[tuple[str, float]],
@@ -46,52 +107,290 @@ def create_app():
     def finish_game() -> dict:
         return make_move_response(None, [], None)
 
-    def continue_game(uci: str, engine_type: str, move_limit: int, training_move: int) -> dict:
-        fast_move = training_move <= 1
-        evaluator = Evaluator(
+    def speculate_replies(evaluator: Evaluator, position: Position, move_time: float, buckets: tuple[int, ...] | None = None):
+        # Depth and node limited searches have no fixed duration, the move time stands in for it.
+        n_replies = int(app.SPECULATION_BUDGET // move_time)
+        try:
+            replies = list(app.explorer.submit_and_get(position.uci, buckets, board=position.board))[:n_replies]
+            evaluator.submit_replies_in_advance(position.uci, replies, board=position.board)
+        except Exception as e:
+            print(f"Speculation for {position.uci} failed: {e}")
+
+    def prefetch_replies(position: Position, buckets: tuple[int, ...] | None = None):
+        # Explorer lookups for the positions after the most popular player replies, done while the player thinks.
+        try:
+            replies = list(app.explorer.submit_and_get(position.uci, buckets, board=position.board))[: app.PREFETCH_REPLIES]
+            for reply in replies:
+                next_position = position.push(reply)
+                app.explorer.submit_job(next_position.uci, buckets, speculative=True, board=next_position.board)
+        except Exception as e:
+            print(f"Prefetch for {position.uci} failed: {e}")
+
+    def make_evaluator(
+        position: Position,
+        engine_type: str,
+        move_time: float,
+        fast_move: bool,
+        limit: AnalysisLimit | None = None,
+        owner: str | None = None,
+    ) -> Evaluator:
+        return Evaluator(
             app.pool,
-            uci,
+            position.uci,
             engine_type,
-            move_limit,
+            limit or move_time,
             n_hints=app.N_HINTS,
             instant=not fast_move,
+            board=position.board,
+            owner=owner,
         )
 
-        moves_dst = app.explorer.submit_and_get(uci)
-
-        diff, best_moves = evaluator.result() if not fast_move else (None, [])
-
+    def explorer_move(position: Position, buckets: tuple[int, ...] | None = None) -> str | None:
+        with metrics.span("explorer"):
+            moves_dst = app.explorer.submit_and_get(position.uci, buckets, board=position.board)
         if len(moves_dst) == 0:
             print("No moves found, finishing game.")
-            return make_move_response(None, best_moves, diff)
+            return None
 
         move, occurrences = sample_move(moves_dst, threshold=app.SAMPLE_THRESHOLD)
         print(f"🧭 Explorer move: {move}, occurrences: {occurrences}")
         if occurrences < app.MIN_OCCURRENCES:
             print("Not enough occurrences, finishing game.")
-            return make_move_response(None, best_moves, diff)
+            return None
+        return move
+
+    def think_ahead(
+        evaluator: Evaluator,
+        next_position: Position,
+        move_time: float,
+        buckets: tuple[int, ...] | None = None,
+        prefetch: bool = False,
+    ):
+        evaluator.submit_jobs_in_advance(next_position.uci, board=next_position.board)
+        if app.SPECULATION_BUDGET > 0:
+            app.speculator.submit(speculate_replies, evaluator, next_position, move_time, buckets)
+        if prefetch:
+            app.speculator.submit(prefetch_replies, next_position, buckets)
 
-        evaluator.submit_jobs_in_advance(f"{uci} {move}")
+    def continue_game(
+        position: Position,
+        engine_type: str,
+        move_time: float,
+        training_move: int,
+        buckets: tuple[int, ...] | None = None,
+        limit: AnalysisLimit | None = None,
+        prefetch: bool = False,
+        owner: str | None = None,
+    ) -> dict:
+        fast_move = training_move <= 1
+        evaluator = make_evaluator(position, engine_type, move_time, fast_move, limit, owner)
+        try:
+            move = explorer_move(position, buckets)
+            diff, best_moves = evaluator.result() if not fast_move else (None, [])
+        finally:
+            # Searches left unclaimed by a failed lookup or evaluation are released.
+            evaluator.cancel()
 
+        if move is not None:
+            think_ahead(evaluator, position.push(move), move_time, buckets, prefetch)
         return make_move_response(move, best_moves, diff)
 
+    def server_event(event: str, data: dict) -> str:
+        return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+    def stream_game(
+        position: Position,
+        engine_type: str,
+        move_time: float,
+        training_move: int,
+        buckets: tuple[int, ...] | None = None,
+        limit: AnalysisLimit | None = None,
+        prefetch: bool = False,
+        on_move: Callable[[str | None], None] | None = None,
+        owner: str | None = None,
+    ) -> Iterator[str]:
+        # The sampled move goes out first, then every depth of the hints search, the last event equals a /make_move response.
+        fast_move = training_move <= 1
+        evaluator = make_evaluator(position, engine_type, move_time, fast_move, limit, owner)
+        move, finished = None, False
+        try:
+            move = explorer_move(position, buckets)
+            if on_move is not None:
+                on_move(move)
+            yield server_event("move", {"sample_move": move})
+
+            diff, best_moves = None, []
+            if not fast_move:
+                for depth, partial_diff, hints in evaluator.updates():
+                    yield server_event("analysis", {"depth": depth, "prev_move_diff": partial_diff, "best_prev_moves": hints})
+                diff, best_moves = evaluator.result()
+            finished = True
+            yield server_event("result", make_move_response(move, best_moves, diff))
+        finally:
+            # A client that disconnects early has seen enough, its search is stopped.
+            if not finished and not fast_move:
+                evaluator.cancel()
+            if move is not None:
+                think_ahead(evaluator, position.push(move), move_time, buckets, prefetch)
+
     @app.route("/")
     def root():
         return render_template("index.html")
 
+    def play(
+        position: Position,
+        orientation: str,
+        engine_type: str,
+        move_time: float,
+        training_move: int,
+        buckets: tuple[int, ...] | None = None,
+        limit: AnalysisLimit | None = None,
+        prefetch: bool = False,
+        owner: str | None = None,
+    ) -> dict:
+        if players_turn(position, orientation):
+            print("It's player's turn, finishing game...")
+            return finish_game()
+        else:
+            return continue_game(position, engine_type, move_time, training_move, buckets, limit, prefetch, owner)
+
+    def players_turn(position: Position, orientation: str) -> bool:
+        return (chess.WHITE if orientation == "white" else chess.BLACK) == position.board.turn
+
+    def event_stream(events: Iterator[str]) -> Response:
+        # The request is over before the body is sent, the stream takes over its trace and finishes it after the last event.
+        trace, endpoint = g.pop("trace"), request.url_rule.rule
+
+        def traced() -> Iterator[str]:
+            metrics.resume_trace(trace)
+            try:
+                yield from events
+            finally:
+                metrics.finish_trace(trace, endpoint)
+
+        return Response(stream_with_context(traced()), mimetype="text/event-stream", headers={"Cache-Control": "no-cache"})
+
     @app.route("/make_move", methods=["POST"])
     @validate()
     def make_move(body: MoveRequest):
-        board = pgn2board(body.pgn)
-        uci = pgn2uci(body.pgn)
+        return play(
+            body.position,
+            body.orientation,
+            body.engine_type,
+            body.move_time,
+            body.training_move,
+            body.buckets,
+            body.analysis_limit,
+        )
 
-        orientation = chess.WHITE if body.orientation == "white" else chess.BLACK
-        players_turn = orientation == board.turn
+    @app.route("/sessions", methods=["POST"])
+    @validate()
+    def create_session(body: SessionRequest):
+        session = TrainingSession(
+            body.position,
+            body.orientation,
+            body.engine_type,
+            body.move_time,
+            body.buckets,
+            body.analysis_limit,
+        )
+        return {"session_id": app.sessions.create(session), "ply": len(session.position.moves)}
 
-        if players_turn:
-            print("It's player's turn, finishing game...")
-            return finish_game()
-        else:
-            return continue_game(uci, body.engine_type, body.move_time, body.training_move)
+    def advance_session(session_id: str, body: SessionMoveRequest) -> tuple[TrainingSession | None, tuple | None]:
+        session = app.sessions.get(session_id)
+        if session is None:
+            return None, (jsonify({"error": "Unknown or expired session"}), 404)
+        try:
+            session.advance(body.ply, body.moves)
+        except SessionConflict as e:
+            return None, (jsonify({"error": str(e)}), 409)
+        except ValueError:
+            return None, (jsonify({"error": "Illegal move"}), 400)
+        return session, None
+
+    @app.route("/sessions/<session_id>/moves", methods=["POST"])
+    @validate()
+    def session_move(session_id: str, body: SessionMoveRequest):
+        with app.sessions.lock(session_id):
+            session, error = advance_session(session_id, body)
+            if error is not None:
+                return error
+
+            response = play(
+                session.position,
+                session.orientation,
+                session.engine_type,
+                session.move_time,
+                body.training_move,
+                session.buckets,
+                session.limit,
+                prefetch=True,
+                owner=session_id,
+            )
+            if response["sample_move"]:
+                session.position = session.position.push(response["sample_move"])
+            app.sessions.save(session_id, session)
+        return response
+
+    @app.route("/make_move/stream", methods=["POST"])
+    @validate()
+    def make_move_stream(body: MoveRequest):
+        position = body.position
+        if players_turn(position, body.orientation):
+            return event_stream(iter([server_event("result", finish_game())]))
+        return event_stream(
+            stream_game(
+                position,
+                body.engine_type,
+                body.move_time,
+                body.training_move,
+                body.buckets,
+                body.analysis_limit,
+            )
+        )
+
+    @app.route("/sessions/<session_id>/moves/stream", methods=["POST"])
+    @validate()
+    def session_move_stream(session_id: str, body: SessionMoveRequest):
+        with app.sessions.lock(session_id):
+            session, error = advance_session(session_id, body)
+            if error is not None:
+                return error
+            if players_turn(session.position, session.orientation):
+                app.sessions.save(session_id, session)
+                return event_stream(iter([server_event("result", finish_game())]))
+
+            def on_move(move: str | None):
+                # Saved before the analysis runs, so the next turn finds the session up to date even if this stream is cut.
+                if move is not None:
+                    session.position = session.position.push(move)
+                app.sessions.save(session_id, session)
+
+            events = stream_game(
+                session.position,
+                session.engine_type,
+                session.move_time,
+                body.training_move,
+                session.buckets,
+                session.limit,
+                prefetch=True,
+                on_move=on_move,
+                owner=session_id,
+            )
+            # The move event is produced under the lock, the session is saved by then and only the analysis streams unlocked.
+            first = next(events)
+        return event_stream(itertools.chain([first], events))
+
+    @app.route("/metrics")
+    def prometheus_metrics():
+        return Response(metrics.render(), mimetype="text/plain; version=0.0.4")
+
+    @app.route("/sessions/<session_id>", methods=["DELETE"])
+    def delete_session(session_id: str):
+        session = app.sessions.delete(session_id)
+        if session is not None:
+            # Speculation on replies to the last bot move is grouped by the session and the position it was made from.
+            app.pool.cancel_group(speculation_group(session.position.uci, session_id))
+        return {}
 
     return app
@@ -0,0 +1,387 @@
+import asyncio
+import json
+import os
+from typing import AsyncIterator
+from typing import Callable
+from typing import Coroutine
+import weakref
+
+import chess
+from dotenv import load_dotenv
+from pydantic import BaseModel
+from pydantic import ValidationError
+from quart import Quart
+from quart import Response
+from quart import g
+from quart import jsonify
+from quart import render_template
+from quart import request
+
+from dmemo import metrics
+from dmemo.aio import AsyncAnalysisPool
+from dmemo.aio import AsyncEvaluator
+from dmemo.aio import AsyncExplorer
+from dmemo.db import aio as aio_crud
+from dmemo.eval import speculation_group
+from dmemo.evalcache import EvalCache
+from dmemo.limits import AnalysisLimit
+from dmemo.protocol import MoveRequest
+from dmemo.protocol import SessionMoveRequest
+from dmemo.protocol import SessionRequest
+from dmemo.training import SessionConflict
+from dmemo.training import SessionStore
+from dmemo.training import TrainingSession
+from dmemo.utils import Position
+from dmemo.utils import sample_move
+
+load_dotenv()
+
+
+def create_asgi_app():
+    # Asyncio counterpart of dmemo.app:create_app: one process serves many concurrent games over a fixed set of engines.
+    app = Quart(__name__)
+
+    app.MIN_OCCURRENCES = 10
+    app.SAMPLE_THRESHOLD = 0.05
+    app.N_HINTS = 3
+    app.SPECULATION_BUDGET = float(os.environ.get("SPECULATION_BUDGET") or 0)
+    app.PREFETCH_REPLIES = 3
+    app.sessions = SessionStore(
+        os.environ.get("SESSION_STORE_PATH"),
+        ttl=float(os.environ.get("SESSION_TTL") or 1800),
+    )
+    # Turns of one session are applied one after another. The locks belong to this process, blocking on a cross-process
+    # lock would stall the event loop.
+    app.session_locks: weakref.WeakValueDictionary[str, asyncio.Lock] = weakref.WeakValueDictionary()
+    app.background: set[asyncio.Task] = set()
+
+    @app.before_serving
+    async def start():
+        app.pool = AsyncAnalysisPool(
+            num_engines=int(os.environ.get("ASYNC_ENGINES") or 6),
+            eval_cache=EvalCache(os.environ.get("EVAL_CACHE_PATH")),
+        )
+        app.explorer = AsyncExplorer(
+            os.environ.get("EXPLORER_CACHE_PATH"),
+            transpositions=os.environ.get("EXPLORER_TRANSPOSITIONS") == "1",
+            book_path=os.environ.get("EXPLORER_BOOK_PATH"),
+        )
+        await aio_crud.init_db()
+
+        def pool_gauges():
+            for section, values in app.pool.metrics().items():
+                if section in ("jobs", "eval_cache"):
+                    yield from metrics.gauges(f"dmemo_pool_{section}", values)
+                else:
+                    yield from metrics.gauges("dmemo_engine", values, engine=section)
+
+        metrics.add_gauges("pool", pool_gauges)
+        metrics.add_gauges("explorer", lambda: metrics.gauges("dmemo_explorer", app.explorer.metrics()))
+
+    @app.after_serving
+    async def stop():
+        for task in list(app.background):
+            task.cancel()
+        await app.pool.close()
+        app.explorer.close()
+        await aio_crud.dispose()
+
+    @app.before_request
+    async def start_trace():
+        g.trace = metrics.start_trace(f"{request.method} {request.path}")
+
+    @app.teardown_request
+    async def finish_trace(_):
+        trace = g.pop("trace", None)
+        if trace is not None:
+            metrics.finish_trace(trace, request.url_rule.rule if request.url_rule else "unmatched")
+
+    def in_background(coroutine: Coroutine):
+        # The loop only keeps weak references to tasks.
+        task = asyncio.create_task(coroutine)
+        app.background.add(task)
+        task.add_done_callback(app.background.discard)
+
+    async def parse_body(model: type[BaseModel]) -> tuple[BaseModel | None, tuple | None]:
+        try:
+            return model.model_validate(await request.get_json(force=True)), None
+        except ValidationError as e:
+            return None, (jsonify({"validation_error": {"body_params": json.loads(e.json())}}), 400)
+
+    def make_move_response(
+        sample_move: str,
+        best_prev_moves: list[tuple[str, float]],
+        prev_move_diff: float,
+    ) -> dict:
+        return {
+            "sample_move": sample_move,
+            "best_prev_moves": best_prev_moves,
+            "prev_move_diff": prev_move_diff,
+        }
+
+    def finish_game() -> dict:
+        return make_move_response(None, [], None)
+
+    async def speculate_replies(evaluator: AsyncEvaluator, position: Position, move_time: float, buckets: tuple[int, ...] | None = None):
+        n_replies = int(app.SPECULATION_BUDGET // move_time)
+        try:
+            replies = list(await app.explorer.submit_and_get(position.uci, buckets, board=position.board))[:n_replies]
+            evaluator.submit_replies_in_advance(position.uci, replies, board=position.board)
+        except Exception as e:
+            print(f"Speculation for {position.uci} failed: {e}")
+
+    async def prefetch_replies(position: Position, buckets: tuple[int, ...] | None = None):
+        try:
+            replies = list(await app.explorer.submit_and_get(position.uci, buckets, board=position.board))[: app.PREFETCH_REPLIES]
+            for reply in replies:
+                next_position = position.push(reply)
+                app.explorer.submit_job(next_position.uci, buckets, speculative=True, board=next_position.board)
+        except Exception as e:
+            print(f"Prefetch for {position.uci} failed: {e}")
+
+    async def explorer_move(position: Position, buckets: tuple[int, ...] | None = None) -> str | None:
+        with metrics.span("explorer"):
+            moves_dst = await app.explorer.submit_and_get(position.uci, buckets, board=position.board)
+        if len(moves_dst) == 0:
+            print("No moves found, finishing game.")
+            return None
+
+        move, occurrences = sample_move(moves_dst, threshold=app.SAMPLE_THRESHOLD)
+        print(f"🧭 Explorer move: {move}, occurrences: {occurrences}")
+        if occurrences < app.MIN_OCCURRENCES:
+            print("Not enough occurrences, finishing game.")
+            return None
+        return move
+
+    def think_ahead(
+        evaluator: AsyncEvaluator,
+        next_position: Position,
+        move_time: float,
+        buckets: tuple[int, ...] | None = None,
+        prefetch: bool = False,
+    ):
+        evaluator.submit_jobs_in_advance(next_position.uci, board=next_position.board)
+        if app.SPECULATION_BUDGET > 0:
+            in_background(speculate_replies(evaluator, next_position, move_time, buckets))
+        if prefetch:
+            in_background(prefetch_replies(next_position, buckets))
+
+    async def game_events(
+        position: Position,
+        orientation: str,
+        engine_type: str,
+        move_time: float,
+        training_move: int,
+        buckets: tuple[int, ...] | None = None,
+        limit: AnalysisLimit | None = None,
+        prefetch: bool = False,
+        on_move: Callable[[str | None], None] | None = None,
+        owner: str | None = None,
+        updates: bool = True,
+    ) -> AsyncIterator[tuple[str, dict]]:
+        if (chess.WHITE if orientation == "white" else chess.BLACK) == position.board.turn:
+            print("It's player's turn, finishing game...")
+            yield "result", finish_game()
+            return
+
+        fast_move = training_move <= 1
+        evaluator = AsyncEvaluator(
+            app.pool,
+            position.uci,
+            engine_type,
+            limit or move_time,
+            n_hints=app.N_HINTS,
+            instant=not fast_move,
+            board=position.board,
+            owner=owner,
+        )
+        move, finished = None, False
+        try:
+            # The hints search already runs as a task while the explorer is asked.
+            move = await explorer_move(position, buckets)
+            if on_move is not None:
+                on_move(move)
+            yield "move", {"sample_move": move}
+
+            # Every depth of the hints search goes out as it completes, like the Flask stream.
+            diff, best_moves = None, []
+            if not fast_move:
+                if updates:
+                    async for depth, partial_diff, hints in evaluator.updates():
+                        yield "analysis", {"depth": depth, "prev_move_diff": partial_diff, "best_prev_moves": hints}
+                diff, best_moves = await evaluator.result()
+            finished = True
+            yield "result", make_move_response(move, best_moves, diff)
+        finally:
+            if not finished and not fast_move:
+                evaluator.cancel()
+            if move is not None:
+                think_ahead(evaluator, position.push(move), move_time, buckets, prefetch)
+
+    async def play(*args, **kwargs) -> dict:
+        # Plain responses only need the result.
+        async for _, data in game_events(*args, updates=False, **kwargs):
+            pass
+        return data
+
+    def event_stream(events: AsyncIterator[tuple[str, dict]]):
+        trace, endpoint = g.pop("trace"), request.url_rule.rule
+
+        async def stream():
+            metrics.resume_trace(trace)
+            try:
+                async for event, data in events:
+                    yield f"event: {event}\ndata: {json.dumps(data)}\n\n".encode()
+            finally:
+                metrics.finish_trace(trace, endpoint)
+
+        return stream(), 200, {"Content-Type": "text/event-stream", "Cache-Control": "no-cache"}
+
+    def session_lock(session_id: str) -> asyncio.Lock:
+        lock = app.session_locks.get(session_id)
+        if lock is None:
+            lock = app.session_locks[session_id] = asyncio.Lock()
+        return lock
+
+    def advance_session(session_id: str, body: SessionMoveRequest) -> tuple[TrainingSession | None, tuple | None]:
+        session = app.sessions.get(session_id)
+        if session is None:
+            return None, (jsonify({"error": "Unknown or expired session"}), 404)
+        try:
+            session.advance(body.ply, body.moves)
+        except SessionConflict as e:
+            return None, (jsonify({"error": str(e)}), 409)
+        except ValueError:
+            return None, (jsonify({"error": "Illegal move"}), 400)
+        return session, None
+
+    @app.route("/")
+    async def root():
+        return await render_template("index.html")
+
+    @app.route("/make_move", methods=["POST"])
+    async def make_move():
+        body, error = await parse_body(MoveRequest)
+        if error is not None:
+            return error
+
+        return await play(
+            body.position,
+            body.orientation,
+            body.engine_type,
+            body.move_time,
+            body.training_move,
+            body.buckets,
+            body.analysis_limit,
+        )
+
+    @app.route("/sessions", methods=["POST"])
+    async def create_session():
+        body, error = await parse_body(SessionRequest)
+        if error is not None:
+            return error
+
+        session = TrainingSession(
+            body.position,
+            body.orientation,
+            body.engine_type,
+            body.move_time,
+            body.buckets,
+            body.analysis_limit,
+        )
+        return {"session_id": app.sessions.create(session), "ply": len(session.position.moves)}
+
+    @app.route("/sessions/<session_id>/moves", methods=["POST"])
+    async def session_move(session_id: str):
+        body, error = await parse_body(SessionMoveRequest)
+        if error is not None:
+            return error
+        async with session_lock(session_id):
+            session, error = advance_session(session_id, body)
+            if error is not None:
+                return error
+
+            response = await play(
+                session.position,
+                session.orientation,
+                session.engine_type,
+                session.move_time,
+                body.training_move,
+                session.buckets,
+                session.limit,
+                prefetch=True,
+                owner=session_id,
+            )
+            if response["sample_move"]:
+                session.position = session.position.push(response["sample_move"])
+            app.sessions.save(session_id, session)
+        return response
+
+    @app.route("/make_move/stream", methods=["POST"])
+    async def make_move_stream():
+        body, error = await parse_body(MoveRequest)
+        if error is not None:
+            return error
+
+        return event_stream(
+            game_events(
+                body.position,
+                body.orientation,
+                body.engine_type,
+                body.move_time,
+                body.training_move,
+                body.buckets,
+                body.analysis_limit,
+            )
+        )
+
+    @app.route("/sessions/<session_id>/moves/stream", methods=["POST"])
+    async def session_move_stream(session_id: str):
+        body, error = await parse_body(SessionMoveRequest)
+        if error is not None:
+            return error
+        async with session_lock(session_id):
+            session, error = advance_session(session_id, body)
+            if error is not None:
+                return error
+            app.sessions.save(session_id, session)
+
+            def on_move(move: str | None):
+                if move is not None:
+                    session.position = session.position.push(move)
+                    app.sessions.save(session_id, session)
+
+            events = game_events(
+                session.position,
+                session.orientation,
+                session.engine_type,
+                session.move_time,
+                body.training_move,
+                session.buckets,
+                session.limit,
+                prefetch=True,
+                on_move=on_move,
+                owner=session_id,
+            )
+            # The move event is produced under the lock, only the analysis streams unlocked.
+            first = await anext(events)
+
+        async def rest() -> AsyncIterator[tuple[str, dict]]:
+            yield first
+            async for event in events:
+                yield event
+
+        return event_stream(rest())
+
+    @app.route("/metrics")
+    async def prometheus_metrics():
+        return Response(metrics.render(), mimetype="text/plain; version=0.0.4")
+
+    @app.route("/sessions/<session_id>", methods=["DELETE"])
+    async def delete_session(session_id: str):
+        session = app.sessions.delete(session_id)
+        if session is not None:
+            app.pool.cancel_group(speculation_group(session.position.uci, session_id))
+        return {}
+
+    return app
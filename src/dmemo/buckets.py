@@ -0,0 +1,67 @@
+from bisect import bisect_right
+
+# Lower bounds of the Lichess explorer rating bands; band 0 also holds unrated games.
+RATING_BANDS = (0, 1000, 1200, 1400, 1600, 1800, 2000, 2200, 2500)
+SPEEDS = ("unknown", "ultrabullet", "bullet", "blitz", "rapid", "classical", "correspondence")
+# Upper bounds of the estimated game duration (base + 40 * increment) per speed, as on Lichess.
+SPEED_LIMITS = ((29, "ultrabullet"), (179, "bullet"), (479, "blitz"), (1499, "rapid"))
+SPEED_BITS = 3
+
+
+def parse_elo(elo) -> int | None:
+    try:
+        return int(elo)
+    except (TypeError, ValueError):
+        return None
+
+
+def rating_band(elo) -> int:
+    elo = parse_elo(elo)
+    return bisect_right(RATING_BANDS[1:], elo) if elo is not None else 0
+
+
+def speed_class(time_control: str | None) -> str:
+    if time_control == "-":
+        return "correspondence"
+    try:
+        base, increment = (int(part) for part in time_control.split("+"))
+    except (AttributeError, ValueError):
+        return "unknown"
+
+    estimate = base + 40 * increment
+    for limit, speed in SPEED_LIMITS:
+        if estimate <= limit:
+            return speed
+    return "classical"
+
+
+def bucket_id(elo, time_control: str | None) -> int:
+    return rating_band(elo) << SPEED_BITS | SPEEDS.index(speed_class(time_control))
+
+
+def game_buckets(white_elo, black_elo, time_control: str | None) -> tuple[int, int]:
+    return bucket_id(white_elo, time_control), bucket_id(black_elo, time_control)
+
+
+def select_buckets(rating_min: int | None = None, rating_max: int | None = None, speeds: list[str] | None = None) -> tuple[int, ...] | None:
+    if rating_min is None and rating_max is None and not speeds:
+        return None
+
+    rating_min = 0 if rating_min is None else rating_min
+    rating_max = float("inf") if rating_max is None else rating_max
+    upper_bounds = RATING_BANDS[1:] + (float("inf"),)
+    bands = [band for band, (lower, upper) in enumerate(zip(RATING_BANDS, upper_bounds)) if lower < rating_max and upper > rating_min]
+    speed_ids = [SPEEDS.index(speed) for speed in speeds] if speeds else range(len(SPEEDS))
+    return tuple(band << SPEED_BITS | speed for band in bands for speed in speed_ids)
+
+
+def bucket_sql(elo: str, time_control: str = "time_control") -> str:
+    thresholds = ", ".join(str(rating) for rating in RATING_BANDS[1:])
+    estimate = f"split_part({time_control}, '+', 1)::int + 40 * split_part({time_control}, '+', 2)::int"
+    speed_cases = " ".join(f"WHEN {estimate} <= {limit} THEN {SPEEDS.index(speed)}" for limit, speed in SPEED_LIMITS)
+    speed = (
+        f"CASE WHEN {time_control} = '-' THEN {SPEEDS.index('correspondence')} "
+        f"WHEN {time_control} ~ '^[0-9]+\\+[0-9]+$' THEN CASE {speed_cases} ELSE {SPEEDS.index('classical')} END "
+        f"ELSE {SPEEDS.index('unknown')} END"
+    )
+    return f"(COALESCE(width_bucket({elo}, ARRAY[{thresholds}]), 0) * {1 << SPEED_BITS} + {speed})"
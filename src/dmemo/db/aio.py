@@ -0,0 +1,69 @@
+from sqlalchemy.ext.asyncio import AsyncEngine
+from sqlalchemy.ext.asyncio import async_sessionmaker
+from sqlalchemy.ext.asyncio import create_async_engine
+
+from dmemo.db import crud
+from dmemo.db.models import Base
+from dmemo.db.session import DATABASE_URL
+from dmemo.metrics import span
+from dmemo.utils import decode_move
+
+# Same database through asyncpg, which is an optional dependency and only loaded once the async backend connects.
+ASYNC_DATABASE_URL = DATABASE_URL.replace("postgresql://", "postgresql+asyncpg://", 1)
+
+_engine: AsyncEngine | None = None
+_sessionmaker: async_sessionmaker | None = None
+
+
+def get_engine() -> AsyncEngine:
+    global _engine, _sessionmaker
+    if _engine is None:
+        _engine = create_async_engine(ASYNC_DATABASE_URL, pool_size=10, max_overflow=10)
+        _sessionmaker = async_sessionmaker(_engine)
+    return _engine
+
+
+def make_session():
+    get_engine()
+    return _sessionmaker()
+
+
+async def init_db():
+    async with get_engine().begin() as connection:
+        await connection.run_sync(Base.metadata.create_all)
+
+
+async def dispose():
+    global _engine, _sessionmaker
+    if _engine is not None:
+        await _engine.dispose()
+        _engine, _sessionmaker = None, None
+
+
+async def get_tree_move_distributions(prefixes: list[str], buckets: tuple[int, ...] | None = None) -> dict[str, dict[str, int]]:
+    with span("db_tree"):
+        async with make_session() as session:
+            result = await session.execute(crud.tree_distributions_query(prefixes, buckets))
+            return crud.group_distributions(prefixes, result.all())
+
+
+async def get_position_move_distributions(parent_hashes: list[int], buckets: tuple[int, ...] | None = None) -> dict[int, dict[str, int]]:
+    with span("db_positions"):
+        async with make_session() as session:
+            result = await session.execute(crud.position_distributions_query(parent_hashes, buckets))
+            return crud.group_distributions(parent_hashes, result.all())
+
+
+async def get_next_move_distribution(opening_uci: str, buckets: tuple[int, ...] | None = None) -> dict[str, int]:
+    opening_uci = opening_uci.strip()
+    num_opening_moves = len(opening_uci.split()) if opening_uci else 0
+    if num_opening_moves < crud.OPENING_TREE_DEPTH:
+        return (await get_tree_move_distributions([opening_uci], buckets))[opening_uci]
+
+    with span("db_games"):
+        async with make_session() as session:
+            if crud.COMPACT_STORAGE:
+                result = await session.execute(crud.compact_distribution_query(opening_uci, buckets))
+                return {decode_move(int.from_bytes(move, "big")).uci(): count for move, count in result.all()}
+            result = await session.execute(crud.game_distribution_query(opening_uci, buckets))
+            return {move: count for move, count in result.all()}
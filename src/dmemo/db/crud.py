@@ -1,8 +1,49 @@
+from collections import Counter
+from contextlib import contextmanager
+import io
+import os
+
+import chess
+from sqlalchemy import Select
 from sqlalchemy import desc
 from sqlalchemy import func
+from sqlalchemy import select
+from sqlalchemy import text
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.orm import Session
 
+from dmemo.buckets import bucket_sql
+from dmemo.buckets import game_buckets
 from dmemo.db.models import Game
+from dmemo.db.models import OpeningTree
+from dmemo.db.models import PositionTree
+from dmemo.db.session import engine
 from dmemo.db.session import make_session
+from dmemo.metrics import span
+from dmemo.utils import decode_move
+from dmemo.utils import decode_moves
+from dmemo.utils import encode_moves
+from dmemo.utils import position_key
+
+OPENING_TREE_DEPTH = int(os.environ.get("OPENING_TREE_DEPTH") or 20)
+TREE_BATCH_SIZE = 10_000
+REBUILD_BATCH_SIZE = 100_000
+COMPACT_STORAGE = os.environ.get("GAMES_STORAGE") == "compact"
+COMPACT_MAX_PLIES = 40
+GAME_COLUMNS = tuple(column.name for column in Game.__table__.columns if not column.primary_key)
+# Full storage never writes moves, so it still loads into games tables created before that column existed.
+FULL_GAME_COLUMNS = tuple(column for column in GAME_COLUMNS if column != "moves")
+
+
+@contextmanager
+def transaction(session: Session | None = None):
+    # Joins the caller's transaction, so games and their tree counts commit together, otherwise commits on its own.
+    if session is not None:
+        yield session
+        return
+    with make_session() as session:
+        yield session
+        session.commit()
 
 
 def add_game(game: Game):
@@ -17,25 +58,225 @@ def add_games(games: list[Game]):
         session.commit()
 
 
-def get_next_move_distribution(opening_uci: str) -> dict[str, int]:
+def insert_games(rows: list[dict], session: Session | None = None):
+    # Core inserts name only the columns present in the rows, unlike ORM objects which write every mapped column.
+    if not rows:
+        return
+    with transaction(session) as session:
+        session.execute(insert(Game), rows)
+
+
+def copy_games(csv_text: str, columns: tuple[str, ...] = GAME_COLUMNS, session: Session | None = None):
+    with transaction(session) as session:
+        with session.connection().connection.cursor() as cursor:
+            cursor.copy_expert(
+                f"COPY {Game.__tablename__} ({', '.join(columns)}) FROM STDIN WITH (FORMAT csv)",
+                io.StringIO(csv_text),
+            )
+
+
+def add_tree_counts(counts: Counter, model=OpeningTree, session: Session | None = None):
+    key_columns = list(model.__table__.primary_key.columns)
+    rows = [{**{column.name: value for column, value in zip(key_columns, key)}, "count": count} for key, count in counts.items()]
+    with transaction(session) as session:
+        for i in range(0, len(rows), TREE_BATCH_SIZE):
+            stmt = insert(model)
+            stmt = stmt.on_conflict_do_update(
+                index_elements=key_columns,
+                set_={"count": model.count + stmt.excluded.count},
+            )
+            session.execute(stmt, rows[i : i + TREE_BATCH_SIZE])
+
+
+def recreate_opening_tree():
+    # Dropping instead of truncating also picks up schema changes such as the bucket key.
+    OpeningTree.__table__.drop(engine, checkfirst=True)
+    OpeningTree.__table__.create(engine)
+
+
+def rebuild_compact_opening_tree(depth: int = OPENING_TREE_DEPTH):
+    counts = Counter()
+    recreate_opening_tree()
+    with make_session() as session:
+        query = session.query(Game.moves, Game.white_elo, Game.black_elo, Game.time_control).filter(Game.moves.isnot(None))
+        for i, (moves, white_elo, black_elo, time_control) in enumerate(query.yield_per(REBUILD_BATCH_SIZE)):
+            buckets = game_buckets(white_elo, black_elo, time_control)
+            uci_moves = decode_moves(moves[: 2 * depth]).split()
+            for ply, move in enumerate(uci_moves):
+                counts[(" ".join(uci_moves[:ply]), buckets[ply % 2], move)] += 1
+            if (i + 1) % REBUILD_BATCH_SIZE == 0:
+                add_tree_counts(counts)
+                counts.clear()
+    add_tree_counts(counts)
+
+
+def rebuild_opening_tree(depth: int = OPENING_TREE_DEPTH):
+    if COMPACT_STORAGE:
+        return rebuild_compact_opening_tree(depth)
+
+    recreate_opening_tree()
+    with make_session() as session:
+        session.execute(
+            text(
+                f"""
+                INSERT INTO {OpeningTree.__tablename__} (parent, bucket, move, count)
+                SELECT
+                    array_to_string(g.moves[1:n.ply - 1], ' '),
+                    CASE WHEN n.ply % 2 = 1 THEN g.white_bucket ELSE g.black_bucket END,
+                    g.moves[n.ply],
+                    count(*)
+                FROM (
+                    SELECT
+                        string_to_array(uci, ' ') AS moves,
+                        {bucket_sql("white_elo")} AS white_bucket,
+                        {bucket_sql("black_elo")} AS black_bucket
+                    FROM {Game.__tablename__}
+                    WHERE uci <> ''
+                ) AS g
+                CROSS JOIN LATERAL generate_series(1, LEAST(array_length(g.moves, 1), :depth)) AS n(ply)
+                GROUP BY 1, 2, 3
+                """
+            ),
+            {"depth": depth},
+        )
+        session.commit()
+
+
+def recreate_position_tree():
+    PositionTree.__table__.drop(engine, checkfirst=True)
+    PositionTree.__table__.create(engine)
+
+
+def rebuild_position_tree(depth: int = OPENING_TREE_DEPTH):
+    # Zobrist hashes are computed in Python, so unlike the opening tree this one is counted outside the database.
+    counts = Counter()
+    recreate_position_tree()
+    moves_column = Game.moves if COMPACT_STORAGE else Game.uci
     with make_session() as session:
-        opening_uci = opening_uci.strip()
+        query = session.query(moves_column, Game.white_elo, Game.black_elo, Game.time_control).filter(moves_column.isnot(None))
+        for i, (moves, white_elo, black_elo, time_control) in enumerate(query.yield_per(REBUILD_BATCH_SIZE)):
+            buckets = game_buckets(white_elo, black_elo, time_control)
+            uci_moves = decode_moves(moves[: 2 * depth]).split() if COMPACT_STORAGE else moves.split()[:depth]
+            board = chess.Board()
+            for ply, move in enumerate(uci_moves):
+                counts[(position_key(board), buckets[ply % 2], move)] += 1
+                board.push_uci(move)
+            if (i + 1) % REBUILD_BATCH_SIZE == 0:
+                add_tree_counts(counts, PositionTree)
+                counts.clear()
+    add_tree_counts(counts, PositionTree)
+
 
-        num_opening_moves = len(opening_uci.split()) if opening_uci else 0
-        next_move_index = num_opening_moves + 1
+def tree_distributions_query(prefixes: list[str], buckets: tuple[int, ...] | None = None) -> Select:
+    move_count = func.sum(OpeningTree.count).label("move_count")
+    query = select(OpeningTree.parent, OpeningTree.move, move_count)
+    query = query.where(OpeningTree.parent.in_(prefixes))
+    if buckets is not None:
+        query = query.where(OpeningTree.bucket.in_(buckets))
+    query = query.group_by(OpeningTree.parent, OpeningTree.move)
+    return query.order_by(OpeningTree.parent, desc(move_count))
 
-        next_move_expr = func.split_part(Game.uci, " ", next_move_index).label("next_move")
 
-        query = session.query(next_move_expr, func.count(Game.id).label("move_count"))
+def position_distributions_query(parent_hashes: list[int], buckets: tuple[int, ...] | None = None) -> Select:
+    move_count = func.sum(PositionTree.count).label("move_count")
+    query = select(PositionTree.parent_hash, PositionTree.move, move_count)
+    query = query.where(PositionTree.parent_hash.in_(parent_hashes))
+    if buckets is not None:
+        query = query.where(PositionTree.bucket.in_(buckets))
+    query = query.group_by(PositionTree.parent_hash, PositionTree.move)
+    return query.order_by(PositionTree.parent_hash, desc(move_count))
 
-        if opening_uci:
-            query = query.filter(Game.uci.like(f"{opening_uci} %"))
 
-        query = query.group_by(next_move_expr)
+def group_distributions(keys: list, rows) -> dict:
+    distributions = {key: {} for key in keys}
+    for key, move, count in rows:
+        distributions[key][move] = int(count)
+    return distributions
 
-        query = query.filter(next_move_expr != "")
 
-        query = query.order_by(desc("move_count"))
+def get_tree_move_distributions(prefixes: list[str], buckets: tuple[int, ...] | None = None) -> dict[str, dict[str, int]]:
+    with span("db_tree"), make_session() as session:
+        return group_distributions(prefixes, session.execute(tree_distributions_query(prefixes, buckets)).all())
 
-        results = query.all()
+
+def get_tree_move_distribution(opening_uci: str, buckets: tuple[int, ...] | None = None) -> dict[str, int]:
+    return get_tree_move_distributions([opening_uci], buckets)[opening_uci]
+
+
+def get_position_move_distributions(parent_hashes: list[int], buckets: tuple[int, ...] | None = None) -> dict[int, dict[str, int]]:
+    with span("db_positions"), make_session() as session:
+        return group_distributions(parent_hashes, session.execute(position_distributions_query(parent_hashes, buckets)).all())
+
+
+def get_position_move_distribution(parent_hash: int, buckets: tuple[int, ...] | None = None) -> dict[str, int]:
+    return get_position_move_distributions([parent_hash], buckets)[parent_hash]
+
+
+def bucket_filter(num_opening_moves: int, buckets: tuple[int, ...]):
+    mover_elo = "white_elo" if num_opening_moves % 2 == 0 else "black_elo"
+    return text(f"{bucket_sql(mover_elo)} IN ({', '.join(str(int(bucket)) for bucket in buckets)})")
+
+
+def compact_distribution_query(opening_uci: str, buckets: tuple[int, ...] | None = None) -> Select:
+    prefix = encode_moves(opening_uci)
+    next_move_expr = func.substring(Game.moves, len(prefix) + 1, 2).label("next_move")
+
+    query = select(next_move_expr, func.count(Game.id).label("move_count"))
+    query = query.where(func.substring(Game.moves, 1, len(prefix)) == prefix)
+    query = query.where(func.length(Game.moves) > len(prefix))
+    if buckets is not None:
+        query = query.where(bucket_filter(len(prefix) // 2, buckets))
+    query = query.group_by(next_move_expr)
+    return query.order_by(desc("move_count"))
+
+
+def get_compact_move_distribution(opening_uci: str, buckets: tuple[int, ...] | None = None) -> dict[str, int]:
+    with span("db_games"), make_session() as session:
+        results = session.execute(compact_distribution_query(opening_uci, buckets)).all()
+        return {decode_move(int.from_bytes(move, "big")).uci(): count for move, count in results}
+
+
+def game_distribution_query(opening_uci: str, buckets: tuple[int, ...] | None = None) -> Select:
+    num_opening_moves = len(opening_uci.split()) if opening_uci else 0
+    next_move_index = num_opening_moves + 1
+
+    next_move_expr = func.split_part(Game.uci, " ", next_move_index).label("next_move")
+
+    query = select(next_move_expr, func.count(Game.id).label("move_count"))
+
+    if opening_uci:
+        query = query.where(Game.uci.like(f"{opening_uci} %"))
+    if buckets is not None:
+        query = query.where(bucket_filter(num_opening_moves, buckets))
+
+    query = query.group_by(next_move_expr)
+
+    query = query.where(next_move_expr != "")
+
+    return query.order_by(desc("move_count"))
+
+
+def get_next_move_distribution(opening_uci: str, buckets: tuple[int, ...] | None = None) -> dict[str, int]:
+    opening_uci = opening_uci.strip()
+    num_opening_moves = len(opening_uci.split()) if opening_uci else 0
+    if num_opening_moves < OPENING_TREE_DEPTH:
+        return get_tree_move_distribution(opening_uci, buckets)
+    if COMPACT_STORAGE:
+        return get_compact_move_distribution(opening_uci, buckets)
+
+    with span("db_games"), make_session() as session:
+        results = session.execute(game_distribution_query(opening_uci, buckets)).all()
         return {move: count for move, count in results}
+
+
+def get_next_move_distributions(opening_ucis: list[str], buckets: tuple[int, ...] | None = None) -> dict[str, dict[str, int]]:
+    # Prefixes inside the opening tree share one indexed query, deeper ones fall back to the game scan.
+    shallow = [uci for uci in opening_ucis if len(uci.split()) < OPENING_TREE_DEPTH]
+    distributions = {}
+    if shallow:
+        tree_distributions = get_tree_move_distributions([uci.strip() for uci in shallow], buckets)
+        distributions.update({uci: tree_distributions[uci.strip()] for uci in shallow})
+    for uci in opening_ucis:
+        if uci not in distributions:
+            distributions[uci] = get_next_move_distribution(uci, buckets)
+    return distributions
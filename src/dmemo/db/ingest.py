@@ -1,25 +1,83 @@
 import argparse
+from collections import Counter
+import csv
+from dataclasses import dataclass
+from dataclasses import field
+from dataclasses import replace
 from datetime import datetime
 from functools import partial
 import io
+import itertools
 from multiprocessing import Pool
 from multiprocessing import cpu_count
 import os
+import re
+import threading
+import time
 from typing import Generator
+from typing import Iterable
 from typing import List
 from typing import Tuple
 
 import chess.pgn
+from sqlalchemy.orm import Session
 import tqdm
+import zstandard
 
-from dmemo.db.crud import add_games
+from dmemo.buckets import game_buckets
+from dmemo.db.crud import COMPACT_MAX_PLIES
+from dmemo.db.crud import COMPACT_STORAGE
+from dmemo.db.crud import FULL_GAME_COLUMNS
+from dmemo.db.crud import GAME_COLUMNS
+from dmemo.db.crud import OPENING_TREE_DEPTH
+from dmemo.db.crud import add_tree_counts
+from dmemo.db.crud import copy_games
+from dmemo.db.crud import insert_games
+from dmemo.db.crud import rebuild_opening_tree
+from dmemo.db.crud import rebuild_position_tree
 from dmemo.db.models import Game
+from dmemo.db.models import PositionTree
+from dmemo.db.session import make_session
+from dmemo.utils import encode_moves
 from dmemo.utils import game2pgn
 from dmemo.utils import game2uci
+from dmemo.utils import position_key
 
 DB_BATCH_SIZE = 1_000_000
 CHUNK_SIZE = 10_000_000
 
+HEADER_RE = re.compile(r'\[(\w+)\s+"((?:[^"\\]|\\.)*)"\]')
+COMMENT_RE = re.compile(r"\{[^}]*\}|;[^\n]*")
+MOVE_NUMBER_RE = re.compile(r"^\d+\.+")
+RESULTS = frozenset(("1-0", "0-1", "1/2-1/2", "*"))
+
+
+class MalformedGame(ValueError):
+    pass
+
+
+@dataclass(frozen=True)
+class IngestOptions:
+    tree_depth: int = OPENING_TREE_DEPTH
+    transpositions: bool = False
+    bulk: bool = False
+    max_plies: int | None = None
+    fast: bool = True
+    compact: bool = COMPACT_STORAGE
+
+    @property
+    def columns(self) -> tuple[str, ...]:
+        return GAME_COLUMNS if self.compact else FULL_GAME_COLUMNS
+
+
+@dataclass
+class ChunkResult:
+    n_games: int = 0
+    games: List[dict] = field(default_factory=list)
+    csv: str = ""
+    tree_counts: Counter = field(default_factory=Counter)
+    position_counts: Counter = field(default_factory=Counter)
+
 
 def parse_date_from_pgn(date_str):
     if not date_str or date_str == "????.??.??":
@@ -30,11 +88,22 @@ def parse_date_from_pgn(date_str):
         return None
 
 
-def process_game(game: chess.pgn.Game) -> Game:
-    headers = game.headers
-    return Game(
-        uci=game2uci(game),
-        pgn=game2pgn(game),
+def header_buckets(headers) -> tuple[int, int]:
+    return game_buckets(headers.get("WhiteElo"), headers.get("BlackElo"), headers.get("TimeControl"))
+
+
+def count_position_moves(game: chess.pgn.Game, depth: int, counts: Counter):
+    board = game.board()
+    buckets = header_buckets(game.headers)
+    for ply, move in enumerate(game.mainline_moves()):
+        if ply >= depth:
+            break
+        counts[(position_key(board), buckets[board.turn == chess.BLACK], move.uci())] += 1
+        board.push(move)
+
+
+def header_fields(headers: chess.pgn.Headers) -> dict:
+    return dict(
         event=headers.get("Event"),
         site=headers.get("Site"),
         date=parse_date_from_pgn(headers.get("Date")),
@@ -54,6 +123,116 @@ def process_game(game: chess.pgn.Game) -> Game:
     )
 
 
+def game_fields(
+    game: chess.pgn.Game,
+    tree_depth: int = OPENING_TREE_DEPTH,
+    position_counts: Counter | None = None,
+    max_plies: int | None = None,
+) -> dict:
+    if position_counts is not None:
+        count_position_moves(game, min(tree_depth, max_plies or tree_depth), position_counts)
+    if max_plies is None:
+        uci, pgn = game2uci(game), game2pgn(game)
+    else:
+        moves = list(itertools.islice(game.mainline_moves(), max_plies))
+        uci, pgn = " ".join(move.uci() for move in moves), game.board().variation_san(moves)
+    return dict(uci=uci, pgn=pgn, **header_fields(game.headers))
+
+
+def process_game(
+    game: chess.pgn.Game,
+    tree_depth: int = OPENING_TREE_DEPTH,
+    position_counts: Counter | None = None,
+    max_plies: int | None = None,
+) -> Game:
+    return Game(**game_fields(game, tree_depth, position_counts, max_plies))
+
+
+def split_games(chunk_text: str) -> Generator[Tuple[dict, str, str], None, None]:
+    # Movetext keeps its line breaks, a ";" comment only runs to the end of its line.
+    headers, movetext, game_lines = {}, [], []
+    for line in chunk_text.splitlines():
+        header = HEADER_RE.fullmatch(line.strip()) if line.startswith("[") else None
+        if header:
+            if movetext:
+                yield headers, "\n".join(movetext), "\n".join(game_lines)
+                headers, movetext, game_lines = {}, [], []
+            headers[header.group(1)] = header.group(2)
+        elif line.strip():
+            movetext.append(line)
+        game_lines.append(line)
+
+    if headers or movetext:
+        yield headers, "\n".join(movetext), "\n".join(game_lines)
+
+
+def format_movetext(san_moves: List[str]) -> str:
+    return " ".join(f"{ply // 2 + 1}. {san}" if ply % 2 == 0 else san for ply, san in enumerate(san_moves))
+
+
+def scan_game_fields(
+    headers: dict,
+    movetext: str,
+    tree_depth: int = OPENING_TREE_DEPTH,
+    position_counts: Counter | None = None,
+    max_plies: int | None = None,
+) -> dict:
+    # Mainline-only games from the standard start, which is all of a Lichess dump.
+    if "FEN" in headers or "(" in movetext:
+        raise MalformedGame("Variations and custom start positions need the full parser.")
+
+    board = chess.Board()
+    buckets = header_buckets(headers)
+    uci_moves, san_moves, positions = [], [], []
+    for token in COMMENT_RE.sub(" ", movetext).split():
+        if token in RESULTS or (max_plies is not None and len(uci_moves) >= max_plies):
+            break
+        token = MOVE_NUMBER_RE.sub("", token).rstrip("!?")
+        if not token or token.startswith("$"):
+            continue
+        move = board.parse_san(token)
+        if position_counts is not None and len(uci_moves) < tree_depth:
+            positions.append((position_key(board), buckets[len(uci_moves) % 2], move.uci()))
+        uci_moves.append(move.uci())
+        san_moves.append(token)
+        board.push(move)
+
+    if position_counts is not None:
+        position_counts.update(positions)
+    return dict(uci=" ".join(uci_moves), pgn=format_movetext(san_moves), **header_fields(chess.pgn.Headers(headers)))
+
+
+def iter_game_fields(chunk_text: str, options: IngestOptions, position_counts: Counter | None) -> Generator[dict, None, None]:
+    if not options.fast:
+        pgn_io = io.StringIO(chunk_text)
+        while True:
+            try:
+                game = chess.pgn.read_game(pgn_io)
+                if game is None:
+                    break
+                yield game_fields(game, options.tree_depth, position_counts, options.max_plies)
+            except Exception:
+                continue
+        return
+
+    for headers, movetext, game_text in split_games(chunk_text):
+        try:
+            yield scan_game_fields(headers, movetext, options.tree_depth, position_counts, options.max_plies)
+        except ValueError:
+            try:
+                game = chess.pgn.read_game(io.StringIO(game_text))
+                if game is not None:
+                    yield game_fields(game, options.tree_depth, position_counts, options.max_plies)
+            except Exception:
+                continue
+
+
+def count_tree_moves(uci: str, depth: int, counts: Counter, buckets: tuple[int, int] = (0, 0)):
+    moves = uci.split()[:depth]
+    for ply, move in enumerate(moves):
+        counts[(" ".join(moves[:ply]), buckets[ply % 2], move)] += 1
+
+
 def find_game_chunks(file_path: str, chunk_size: int) -> Generator[Tuple[int, int], None, None]:
     file_size = os.path.getsize(file_path)
     if file_size == 0:
@@ -79,49 +258,149 @@ def find_game_chunks(file_path: str, chunk_size: int) -> Generator[Tuple[int, in
                 break
 
 
-def process_chunk(path, positions) -> List[Game]:
+def stream_game_chunks(file_path: str, chunk_size: int) -> Generator[str, None, None]:
+    with open(file_path, "rb") as f:
+        reader = zstandard.ZstdDecompressor().stream_reader(f, read_across_frames=True)
+        text_reader = io.TextIOWrapper(reader, encoding="utf-8-sig")
+        pending = ""
+        while True:
+            block = text_reader.read(chunk_size)
+            if not block:
+                break
+            text = pending + block
+            cut = text.rfind("\n[Event ")
+            if cut <= 0:
+                pending = text
+                continue
+            yield text[: cut + 1]
+            pending = text[cut + 1 :]
+
+        if pending:
+            yield pending
+
+
+def store_fields(fields: dict, options: IngestOptions) -> dict:
+    if options.compact:
+        fields.update(moves=encode_moves(fields["uci"]), uci=None, pgn=None)
+    return fields
+
+
+def copy_value(value):
+    return f"\\x{value.hex()}" if isinstance(value, bytes) else value
+
+
+def process_text(options: IngestOptions, chunk_text: str) -> ChunkResult:
+    result = ChunkResult()
+    position_counts = result.position_counts if options.transpositions else None
+    # QUOTE_NOTNULL leaves None unquoted, which COPY reads as NULL.
+    csv_io = io.StringIO()
+    writer = csv.writer(csv_io, quoting=csv.QUOTE_NOTNULL)
+
+    for fields in iter_game_fields(chunk_text, options, position_counts):
+        buckets = game_buckets(fields["white_elo"], fields["black_elo"], fields["time_control"])
+        count_tree_moves(fields["uci"], options.tree_depth, result.tree_counts, buckets)
+        fields = store_fields(fields, options)
+        if options.bulk:
+            writer.writerow([copy_value(fields[column]) for column in options.columns])
+        else:
+            result.games.append(fields)
+        result.n_games += 1
+
+    result.csv = csv_io.getvalue()
+    return result
+
+
+def process_chunk(path: str, options: IngestOptions, positions: Tuple[int, int]) -> ChunkResult:
     start_pos, end_pos = positions
-    processed_games = []
     with open(path, "r", encoding="utf-8-sig") as f:
         f.seek(start_pos)
         chunk_text = f.read(end_pos - start_pos)
-        pgn_io = io.StringIO(chunk_text)
+    return process_text(options, chunk_text)
+
+
+def bounded(items: Iterable, semaphore: threading.Semaphore) -> Generator:
+    # The pool's task feeder blocks here, so at most N chunks are parsed but not yet loaded.
+    for item in items:
+        semaphore.acquire()
+        yield item
+
+
+def flush(session: Session, games_buffer: List[dict], tree_buffer: Counter, position_buffer: Counter):
+    # Games copied since the last flush are part of the same transaction, a failed batch leaves neither games nor counts.
+    insert_games(games_buffer, session)
+    add_tree_counts(tree_buffer, session=session)
+    add_tree_counts(position_buffer, PositionTree, session)
+    session.commit()
+    games_buffer.clear()
+    tree_buffer.clear()
+    position_buffer.clear()
 
-        while True:
-            try:
-                game = chess.pgn.read_game(pgn_io)
-                if game is None:
-                    break
-                processed_games.append(process_game(game))
-            except Exception:
-                continue
 
-    return processed_games
+def read_sample(path: str, size: int) -> str:
+    if path.endswith(".zst"):
+        return next(stream_game_chunks(path, size), "")
+    with open(path, "r", encoding="utf-8-sig") as f:
+        text = f.read(size)
+    cut = text.rfind("\n[Event ")
+    return text[: cut + 1] if cut > 0 else text
+
+
+def benchmark_parsers(path: str, sample_size: int, options: IngestOptions):
+    chunk_text = read_sample(path, sample_size)
+    print(f"Benchmarking parsers on {len(chunk_text) / 1e6:.1f} MB of {path}...")
 
+    rates = {}
+    for name, fast in (("python-chess", False), ("fast scanner", True)):
+        start = time.perf_counter()
+        result = process_text(replace(options, bulk=True, fast=fast), chunk_text)
+        elapsed = time.perf_counter() - start
+        rates[name] = result.n_games / elapsed if elapsed else 0.0
+        print(f"⏱️ {name:<13} {result.n_games} games in {elapsed:.2f}s, {rates[name]:,.0f} games/s")
 
-def import_games_parallel(path: str, num_workers: int, total: int = None):
+    if rates["python-chess"]:
+        print(f"🚀 Speedup: {rates['fast scanner'] / rates['python-chess']:.1f}x")
+
+
+def import_games_parallel(path: str, num_workers: int, total: int = None, options: IngestOptions = IngestOptions()):
     print(f"Starting parallel import with {num_workers} workers...")
 
-    chunk_generator = find_game_chunks(path, CHUNK_SIZE)
+    if path.endswith(".zst"):
+        chunks = stream_game_chunks(path, CHUNK_SIZE)
+        process = partial(process_text, options)
+    else:
+        chunks = find_game_chunks(path, CHUNK_SIZE)
+        process = partial(process_chunk, path, options)
+
+    semaphore = threading.Semaphore(num_workers * 2)
+    chunk_generator = bounded(chunks, semaphore)
 
     games_buffer = []
+    tree_buffer = Counter()
+    position_buffer = Counter()
     games_processed_count = 0
+    games_since_flush = 0
     pbar = tqdm.tqdm(total=total, desc="⚙️ Processing Games", unit="games")
 
-    with Pool(processes=num_workers) as pool:
-        for processed_games_list in pool.imap_unordered(partial(process_chunk, path), chunk_generator):
-            if processed_games_list:
-                games_buffer.extend(processed_games_list)
-                games_processed_count += len(processed_games_list)
-                pbar.update(len(processed_games_list))
+    with Pool(processes=num_workers) as pool, make_session() as session:
+        for result in pool.imap_unordered(process, chunk_generator):
+            semaphore.release()
+            if result.n_games:
+                if options.bulk:
+                    copy_games(result.csv, options.columns, session)
+                else:
+                    games_buffer.extend(result.games)
+                tree_buffer.update(result.tree_counts)
+                position_buffer.update(result.position_counts)
+                games_processed_count += result.n_games
+                games_since_flush += result.n_games
+                pbar.update(result.n_games)
 
-                if len(games_buffer) >= DB_BATCH_SIZE:
-                    add_games(games_buffer)
-                    games_buffer.clear()
+                if games_since_flush >= DB_BATCH_SIZE:
+                    flush(session, games_buffer, tree_buffer, position_buffer)
+                    games_since_flush = 0
 
-    if games_buffer:
-        add_games(games_buffer)
-        games_buffer.clear()
+        if games_since_flush:
+            flush(session, games_buffer, tree_buffer, position_buffer)
 
     pbar.close()
     print(f"\n✅ Finished. Imported a total of {games_processed_count} games.")
@@ -132,7 +411,7 @@ if __name__ == "__main__":
         description="High-performance parallel importer for PGN files.",
         formatter_class=argparse.ArgumentDefaultsHelpFormatter,
     )
-    parser.add_argument("file", help="PGN file to import")
+    parser.add_argument("file", nargs="?", help="PGN file to import, plain or .pgn.zst")
     parser.add_argument(
         "--num-workers",
         type=int,
@@ -145,6 +424,63 @@ if __name__ == "__main__":
         help="Total number of games for the progress bar.",
         default=None,
     )
+    parser.add_argument(
+        "--transpositions",
+        action="store_true",
+        help="Also aggregate the opening tree by position hash for transposition-aware lookups.",
+    )
+    parser.add_argument(
+        "--bulk",
+        action="store_true",
+        help="Stream games into Postgres with COPY instead of ORM inserts.",
+    )
+    parser.add_argument(
+        "--max-plies",
+        type=int,
+        default=None,
+        help="Only convert and store the first N plies of each game.",
+    )
+    parser.add_argument(
+        "--storage",
+        choices=["full", "compact"],
+        default="compact" if COMPACT_STORAGE else "full",
+        help=f"Full uci/pgn strings, or only the first plies as 16-bit move codes (default {COMPACT_MAX_PLIES} plies).",
+    )
+    parser.add_argument(
+        "--parser",
+        choices=["fast", "full"],
+        default="fast",
+        help="Fast header/SAN scanner with python-chess fallback, or full python-chess parsing.",
+    )
+    parser.add_argument(
+        "--benchmark",
+        action="store_true",
+        help="Compare parser throughput on the start of the file instead of importing it.",
+    )
+    parser.add_argument(
+        "--rebuild-tree",
+        action="store_true",
+        help="Rebuild the opening tree from the games already in the database, and the position tree with --transpositions.",
+    )
     args = parser.parse_args()
+    # Lookups trust the tree up to OPENING_TREE_DEPTH plies, a shallower tree would answer them with empty moves.
+    if args.max_plies is not None and args.max_plies < OPENING_TREE_DEPTH:
+        parser.error(f"--max-plies must be at least OPENING_TREE_DEPTH ({OPENING_TREE_DEPTH}).")
 
-    import_games_parallel(args.file, args.num_workers, args.total)
+    if args.rebuild_tree:
+        print(f"Rebuilding the opening tree up to {OPENING_TREE_DEPTH} plies...")
+        rebuild_opening_tree(OPENING_TREE_DEPTH)
+        if args.transpositions:
+            print(f"Rebuilding the position tree up to {OPENING_TREE_DEPTH} plies...")
+            rebuild_position_tree(OPENING_TREE_DEPTH)
+    options = IngestOptions(
+        transpositions=args.transpositions,
+        bulk=args.bulk,
+        max_plies=args.max_plies or (COMPACT_MAX_PLIES if args.storage == "compact" else None),
+        fast=args.parser == "fast",
+        compact=args.storage == "compact",
+    )
+    if args.file and args.benchmark:
+        benchmark_parsers(args.file, CHUNK_SIZE, options)
+    elif args.file:
+        import_games_parallel(args.file, args.num_workers, args.total, options)
@@ -0,0 +1,112 @@
+import argparse
+
+from sqlalchemy import text
+import tqdm
+
+from dmemo.db.crud import COMPACT_MAX_PLIES
+from dmemo.db.models import Game
+from dmemo.db.models import OpeningTree
+from dmemo.db.models import PositionTree
+from dmemo.db.session import engine
+from dmemo.db.session import make_session
+from dmemo.utils import encode_moves
+
+BATCH_SIZE = 50_000
+
+
+def add_moves_column():
+    with make_session() as session:
+        session.execute(text(f"ALTER TABLE {Game.__tablename__} ADD COLUMN IF NOT EXISTS moves bytea"))
+        session.commit()
+
+
+def backfill_moves(max_plies: int, batch_size: int = BATCH_SIZE):
+    with make_session() as session:
+        total = session.query(Game.id).filter(Game.moves.is_(None), Game.uci.isnot(None)).count()
+
+    pbar = tqdm.tqdm(total=total, desc="📦 Encoding moves", unit="games")
+    last_id = 0
+    while True:
+        with make_session() as session:
+            rows = (
+                session.query(Game.id, Game.uci)
+                .filter(Game.id > last_id, Game.moves.is_(None), Game.uci.isnot(None))
+                .order_by(Game.id)
+                .limit(batch_size)
+                .all()
+            )
+            if not rows:
+                break
+
+            updates = [{"id": id, "moves": encode_moves(" ".join(uci.split()[:max_plies]))} for id, uci in rows]
+            session.execute(text(f"UPDATE {Game.__tablename__} SET moves = :moves WHERE id = :id"), updates)
+            session.commit()
+
+        last_id = rows[-1][0]
+        pbar.update(len(rows))
+    pbar.close()
+
+
+def drop_strings(drop_uci: bool, drop_pgn: bool):
+    columns = [column for column, drop in (("uci", drop_uci), ("pgn", drop_pgn)) if drop]
+    if not columns:
+        return
+    with make_session() as session:
+        assignments = ", ".join(f"{column} = NULL" for column in columns)
+        session.execute(text(f"UPDATE {Game.__tablename__} SET {assignments} WHERE moves IS NOT NULL"))
+        session.commit()
+    print(f"Cleared {', '.join(columns)}. Run VACUUM FULL {Game.__tablename__} to return the space to the OS.")
+
+
+def recreate_tree_tables():
+    for model in (OpeningTree, PositionTree):
+        model.__table__.drop(engine, checkfirst=True)
+        model.__table__.create(engine)
+    print("Recreated the opening and position trees with bucket keys.")
+    print("Run `python -m dmemo.db.ingest --rebuild-tree --transpositions` to fill them from the games table.")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Migrate the games table to compact move storage and the tree tables to bucket keys.",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    parser.add_argument(
+        "--moves",
+        action="store_true",
+        help="Add the compact moves column and encode every game into it.",
+    )
+    parser.add_argument(
+        "--max-plies",
+        type=int,
+        default=COMPACT_MAX_PLIES,
+        help="Number of plies kept in the compact moves column.",
+    )
+    parser.add_argument(
+        "--drop-uci",
+        action="store_true",
+        help="Clear the uci column once moves are encoded.",
+    )
+    parser.add_argument(
+        "--drop-pgn",
+        action="store_true",
+        help="Clear the pgn column once moves are encoded.",
+    )
+    parser.add_argument(
+        "--recreate-trees",
+        action="store_true",
+        help="Drop and recreate the opening/position tree tables with the rating/speed bucket key.",
+    )
+    args = parser.parse_args()
+    if not args.moves and not args.recreate_trees:
+        parser.error("Nothing to migrate, pass --moves and/or --recreate-trees.")
+    if (args.drop_uci or args.drop_pgn) and not args.moves:
+        parser.error("--drop-uci and --drop-pgn only apply together with --moves.")
+
+    if args.recreate_trees:
+        recreate_tree_tables()
+    if args.moves:
+        add_moves_column()
+        backfill_moves(args.max_plies)
+        drop_strings(args.drop_uci, args.drop_pgn)
+        print("✅ Migration finished. Set GAMES_STORAGE=compact to query the moves column.")
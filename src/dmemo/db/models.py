@@ -1,6 +1,9 @@
+from sqlalchemy import BigInteger
 from sqlalchemy import Column
 from sqlalchemy import Date
 from sqlalchemy import Integer
+from sqlalchemy import LargeBinary
+from sqlalchemy import SmallInteger
 from sqlalchemy import String
 from sqlalchemy import Time
 from sqlalchemy.orm import declarative_base
@@ -14,6 +17,7 @@ class Game(Base):
     id = Column(Integer, primary_key=True)
     uci = Column(String)
     pgn = Column(String)
+    moves = Column(LargeBinary)
 
     event = Column(String)
     site = Column(String)
@@ -31,3 +35,21 @@ class Game(Base):
     opening = Column(String)
     time_control = Column(String)
     termination = Column(String)
+
+
+class OpeningTree(Base):
+    __tablename__ = "opening_tree"
+
+    parent = Column(String, primary_key=True)
+    bucket = Column(SmallInteger, primary_key=True, default=0)
+    move = Column(String, primary_key=True)
+    count = Column(BigInteger, nullable=False, default=0)
+
+
+class PositionTree(Base):
+    __tablename__ = "position_tree"
+
+    parent_hash = Column(BigInteger, primary_key=True)
+    bucket = Column(SmallInteger, primary_key=True, default=0)
+    move = Column(String, primary_key=True)
+    count = Column(BigInteger, nullable=False, default=0)
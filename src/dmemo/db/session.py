@@ -13,7 +13,8 @@ PASSWORD = os.environ.get("POSTGRES_PASSWORD")
 HOST = os.environ.get("POSTGRES_HOST", "localhost")
 PORT = os.environ.get("POSTGRES_PORT", "5432")
 DB = os.environ.get("POSTGRES_DB")
-DATABASE_URL = f"postgresql://{USER}:{PASSWORD}@{HOST}:{PORT}/{DB}"
+# A full SQLAlchemy URL takes precedence over the POSTGRES_* settings, e.g. for a local stand-in database.
+DATABASE_URL = os.environ.get("DATABASE_URL") or f"postgresql://{USER}:{PASSWORD}@{HOST}:{PORT}/{DB}"
 
 engine = create_engine(DATABASE_URL)
 Session = sessionmaker(bind=engine)
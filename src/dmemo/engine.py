@@ -1,118 +1,519 @@
 from abc import ABC
 from concurrent.futures import Future
 from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+import contextvars
 import os
+import pickle
+import queue
+import threading
+import time
+from typing import Callable
 from typing import Dict
 
 import chess
 import chess.engine
 from dotenv import load_dotenv
 
+from dmemo.evalcache import EvalCache
+from dmemo.jobs import JobRegistry
+from dmemo.jobs import Progress
+from dmemo.limits import AnalysisLimit
+from dmemo.limits import StabilityTracker
+from dmemo.metrics import record_span
+from dmemo.metrics import span
 from dmemo.utils import uci2board
 
 load_dotenv()
 
 
 class Book:
-    def __init__(self, book_path: str):
+    def __init__(self, book_path: str, index_path: str | None = None):
         self.book_path = book_path
-        self.book = self._read_book(book_path)
-
-    def _read_book(self, path):
+        self.index_path = index_path
+        self.book = self._load_index()
+        if self.book is None:
+            self.book = self._read_book(book_path)
+            if index_path:
+                self._save_index()
+
+    def _read_book(self, path) -> dict:
+        # Move trie: every node maps a UCI move to the node reached after playing it.
+        trie = {}
         with open(path) as f:
-            book_raw = f.read()
-            uci_games = book_raw.split("\n")[0:-1]
-
-        return uci_games
+            for line in f:
+                node = trie
+                for move in line.split():
+                    node = node.setdefault(move, {})
+        return trie
+
+    def _stamp(self) -> tuple[int, int]:
+        stat = os.stat(self.book_path)
+        return stat.st_mtime_ns, stat.st_size
+
+    def _load_index(self) -> dict | None:
+        if not self.index_path or not os.path.exists(self.index_path):
+            return None
+        with open(self.index_path, "rb") as f:
+            stamp, trie = pickle.load(f)
+        return trie if stamp == self._stamp() else None
+
+    def _save_index(self):
+        tmp_path = f"{self.index_path}.tmp"
+        with open(tmp_path, "wb") as f:
+            pickle.dump((self._stamp(), self.book), f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, self.index_path)
 
     def find(self, uci: str) -> set[str]:
-        moves = []
-        for game in self.book:
-            if game.startswith(uci) and len(game) > len(uci):
-                move = game[len(uci) :].split()[0]
-                moves.append(move)
-        return set(moves)
+        node = self.book
+        for move in uci.split():
+            node = node.get(move)
+            if node is None:
+                return set()
+        return set(node)
 
 
 class Engine(ABC):
-    def __init__(self, path: str):
+    def __init__(self, path: str, options: dict | None = None):
         self._engine = chess.engine.SimpleEngine.popen_uci(path)
-
-    def analyze(self, uci: str, time_limit: float, multi_pv: int) -> list[dict]:
-        result = self._engine.analyse(uci2board(uci), chess.engine.Limit(time=time_limit), multipv=multi_pv)
+        self.options = {**self.default_options(), **(options or {})}
+        if self.options:
+            self._engine.configure(self.options)
+        self.last_used = time.monotonic()
+
+    @classmethod
+    def default_options(cls) -> dict:
+        return {}
+
+    def analyze(
+        self,
+        position: str | chess.Board,
+        limit: AnalysisLimit | float,
+        multi_pv: int,
+        new_game: bool = True,
+        root_moves: list[str] | None = None,
+        on_info: Callable[[list[dict]], bool] | None = None,
+    ) -> list[dict]:
+        # A fresh game key makes python-chess send `ucinewgame`, which also clears the hash.
+        game = object() if new_game else None
+        limit = AnalysisLimit.of(limit)
+        board = position if isinstance(position, chess.Board) else uci2board(position)
+        root_moves = [chess.Move.from_uci(move) for move in root_moves] if root_moves else None
+        if limit.stable_depths or on_info is not None:
+            return self._analyze_streaming(board, limit, multi_pv, game, root_moves, on_info)
+
+        result = self._engine.analyse(
+            board,
+            limit.engine_limit(),
+            multipv=multi_pv,
+            game=game,
+            root_moves=root_moves,
+        )
         return result
 
+    def _analyze_streaming(
+        self,
+        board: chess.Board,
+        limit: AnalysisLimit,
+        multi_pv: int,
+        game,
+        root_moves,
+        on_info: Callable[[list[dict]], bool] | None = None,
+    ) -> list[dict]:
+        tracker = StabilityTracker(limit.stable_depths) if limit.stable_depths else None
+        with self._engine.analysis(board, limit.engine_limit(), multipv=multi_pv, game=game, root_moves=root_moves) as analysis:
+            for info in analysis:
+                if tracker is not None and info.get("multipv", 1) == 1 and tracker.update(info):
+                    analysis.stop()
+                # A depth is complete once its last line arrived, on_info returns false when the search is no longer wanted.
+                if on_info is not None and "pv" in info and info.get("multipv", 1) == len(analysis.multipv):
+                    if not on_info([dict(line) for line in analysis.multipv]):
+                        analysis.stop()
+            analysis.wait()
+            return analysis.multipv
+
+    def is_alive(self) -> bool:
+        try:
+            self._engine.ping()
+            return True
+        except (chess.engine.EngineError, chess.engine.EngineTerminatedError, TimeoutError):
+            return False
+
+    def close(self):
+        try:
+            self._engine.quit()
+        except (chess.engine.EngineError, chess.engine.EngineTerminatedError, TimeoutError):
+            self._engine.close()
+
     def __enter__(self):
         return self
 
     def __exit__(self, exc_type, exc_val, exc_tb):
-        self._engine.quit()
+        self.close()
 
 
 class LcZeroEngine(Engine):
-    def __init__(self):
-        super().__init__(os.environ.get("LCZERO_PATH"))
-        self._engine.configure({"WeightsFile": os.environ.get("LCZERO_WEIGHTS")})
+    def __init__(self, options: dict | None = None):
+        super().__init__(self.default_path(), options)
+
+    @classmethod
+    def default_path(cls) -> str:
+        return os.environ.get("LCZERO_PATH")
+
+    @classmethod
+    def default_options(cls) -> dict:
+        return {"WeightsFile": os.environ.get("LCZERO_WEIGHTS")}
 
 
 class StockfishEngine(Engine):
-    def __init__(self):
-        super().__init__(os.environ.get("STOCKFISH_PATH"))
+    def __init__(self, options: dict | None = None):
+        super().__init__(self.default_path(), options)
+
+    @classmethod
+    def default_path(cls) -> str:
+        return os.environ.get("STOCKFISH_PATH")
 
 
-def make_engine(engine_type: str) -> Engine:
-    if engine_type == "lczero":
-        return LcZeroEngine()
-    elif engine_type == "stockfish":
-        return StockfishEngine()
-    else:
+ENGINES = {
+    "lczero": LcZeroEngine,
+    "stockfish": StockfishEngine,
+}
+
+
+def make_engine(engine_type: str, options: dict | None = None) -> Engine:
+    if engine_type not in ENGINES:
         raise ValueError(f"Unknown engine type: {engine_type}")
+    return ENGINES[engine_type](options)
+
+
+def engine_options(engine_type: str, options: dict | None = None) -> dict:
+    return {**ENGINES[engine_type].default_options(), **(options or {})}
+
+
+class EnginePool:
+    def __init__(self, engine_type: str, size: int, options: dict | None = None, ping_after: float = 30.0):
+        if engine_type not in ENGINES:
+            raise ValueError(f"Unknown engine type: {engine_type}")
+        if size <= 0:
+            raise ValueError("Engine pool size must be a positive integer.")
+
+        self.engine_type = engine_type
+        self.size = size
+        self.options = options
+        self.ping_after = ping_after
+
+        # LIFO keeps the most recently used (warmest) engine in rotation.
+        self._idle: queue.LifoQueue[Engine] = queue.LifoQueue()
+        self._lock = threading.Lock()
+        self._spawned = 0
+
+        self.checkouts = 0
+        self.restarts = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+
+    def _spawn(self) -> Engine:
+        try:
+            return make_engine(self.engine_type, self.options)
+        except Exception:
+            with self._lock:
+                self._spawned -= 1
+            raise
+
+    def warmup(self):
+        while True:
+            with self._lock:
+                if self._spawned >= self.size:
+                    return
+                self._spawned += 1
+            self._idle.put(self._spawn())
+
+    def checkout(self) -> Engine:
+        start = time.perf_counter()
+        try:
+            engine = self._idle.get_nowait()
+        except queue.Empty:
+            with self._lock:
+                can_spawn = self._spawned < self.size
+                if can_spawn:
+                    self._spawned += 1
+            engine = self._spawn() if can_spawn else self._idle.get()
+
+        wait = time.perf_counter() - start
+        record_span("engine_checkout", wait, start)
+        with self._lock:
+            self.checkouts += 1
+            self.wait_total += wait
+            self.wait_max = max(self.wait_max, wait)
+
+        if time.monotonic() - engine.last_used > self.ping_after and not engine.is_alive():
+            print(f"🩺 Idle {self.engine_type} engine failed the health check, restarting.")
+            engine = self.restart(engine)
+        return engine
+
+    def checkin(self, engine: Engine):
+        engine.last_used = time.monotonic()
+        self._idle.put(engine)
+
+    def restart(self, engine: Engine) -> Engine:
+        engine.close()
+        with self._lock:
+            self.restarts += 1
+        return self._spawn()
+
+    def discard(self, engine: Engine):
+        # The slot is freed, a fresh engine is spawned at a later checkout.
+        engine.close()
+        with self._lock:
+            self._spawned -= 1
+
+    @contextmanager
+    def engine(self):
+        engine = self.checkout()
+        try:
+            yield engine
+        finally:
+            self.checkin(engine)
+
+    def metrics(self) -> dict:
+        with self._lock:
+            return {
+                "size": self.size,
+                "spawned": self._spawned,
+                "idle": self._idle.qsize(),
+                "busy": self._spawned - self._idle.qsize(),
+                "checkouts": self.checkouts,
+                "restarts": self.restarts,
+                "wait_total": self.wait_total,
+                "wait_max": self.wait_max,
+                "wait_avg": self.wait_total / self.checkouts if self.checkouts else 0.0,
+            }
+
+    def close(self):
+        while True:
+            try:
+                engine = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            engine.close()
+            with self._lock:
+                self._spawned -= 1
 
 
 class ChessAnalysisPool:
-    def __init__(self, num_workers: int = 2):
+    def __init__(
+        self,
+        num_workers: int = 2,
+        engine_options: Dict[str, dict] | None = None,
+        warm_engines: tuple[str, ...] = (),
+        new_game: bool = True,
+        eval_cache: EvalCache | None = None,
+        job_ttl: float = 300.0,
+        max_jobs: int = 1024,
+    ):
         if num_workers <= 0:
             raise ValueError("Number of workers must be a positive integer.")
 
+        self.num_workers = num_workers
+        self.engine_options = engine_options or {}
+        self.new_game = new_game
+        self.eval_cache = eval_cache
         self.executor = ThreadPoolExecutor(max_workers=num_workers, thread_name_prefix="ChessWorker")
 
-        self._futures: Dict[str, Future] = {}
+        self._jobs = JobRegistry(ttl=job_ttl, max_jobs=max_jobs)
+        self._engine_pools: Dict[str, EnginePool] = {}
+        self._engine_pools_lock = threading.Lock()
+        self._queued = 0
+        self._running = 0
+        self._counters_lock = threading.Lock()
+        for engine_type in warm_engines:
+            self.engine_pool(engine_type).warmup()
         print(f"♟️ Chess Analysis Pool initialized with {num_workers} workers.")
 
     @staticmethod
-    def job_id(uci: str, multi_pv: int):
-        return f"{multi_pv}_{uci}"
-
-    def _run_analysis(self, uci: str, engine_type: str, time_limit: float, multi_pv: int) -> list[dict]:
-        with make_engine(engine_type) as engine:
-            engine_moves = engine.analyze(uci, time_limit, multi_pv)
-            return engine_moves
+    def job_id(uci: str, engine_type: str, multi_pv: int, root_moves: list[str] | None = None, limit: AnalysisLimit | float | None = None):
+        # Engines disagree on scores, a search by one must never answer for another.
+        id = f"{engine_type}_{multi_pv}_{uci}"
+        if root_moves:
+            id = f"{id}_{','.join(root_moves)}"
+        if limit is not None:
+            id = f"{id}@{AnalysisLimit.of(limit).key()}"
+        return id
 
-    def submit_job(self, uci: str, engine_type: str, time_limit: int, multi_pv: int) -> str:
-        id = self.job_id(uci, multi_pv)
-        if id in self._futures:
+    def engine_pool(self, engine_type: str) -> EnginePool:
+        with self._engine_pools_lock:
+            if engine_type not in self._engine_pools:
+                self._engine_pools[engine_type] = EnginePool(
+                    engine_type,
+                    size=self.num_workers,
+                    options=self.engine_options.get(engine_type),
+                )
+            return self._engine_pools[engine_type]
+
+    def _run_analysis(
+        self,
+        uci: str,
+        engine_type: str,
+        limit: AnalysisLimit,
+        multi_pv: int,
+        root_moves: list[str] | None = None,
+        board: chess.Board | None = None,
+        progress: Progress | None = None,
+    ) -> list[dict]:
+        with self._counters_lock:
+            self._queued -= 1
+            self._running += 1
+        try:
+            return self._analyse_position(uci, engine_type, limit, multi_pv, root_moves, board, progress)
+        finally:
+            with self._counters_lock:
+                self._running -= 1
+
+    def _analyse_position(
+        self,
+        uci: str,
+        engine_type: str,
+        limit: AnalysisLimit,
+        multi_pv: int,
+        root_moves: list[str] | None = None,
+        board: chess.Board | None = None,
+        progress: Progress | None = None,
+    ) -> list[dict]:
+        board = board if board is not None else uci2board(uci)
+        if self.eval_cache is None:
+            return self._run_engine(board, engine_type, limit, multi_pv, root_moves, progress)
+
+        options = engine_options(engine_type, self.engine_options.get(engine_type))
+        key = self.eval_cache.key(board, engine_type, options, root_moves)
+        cached = self.eval_cache.get(key, multi_pv, limit)
+        if cached is not None:
+            return cached
+
+        engine_moves = self._run_engine(board, engine_type, limit, multi_pv, root_moves, progress)
+        # A stopped search fell short of its limit.
+        if progress is None or not progress.stopped:
+            self.eval_cache.put(key, engine_moves, multi_pv, limit)
+        return engine_moves
+
+    def _run_engine(
+        self,
+        board: chess.Board,
+        engine_type: str,
+        limit: AnalysisLimit,
+        multi_pv: int,
+        root_moves: list[str] | None = None,
+        progress: Progress | None = None,
+    ) -> list[dict]:
+        on_info = progress.publish if progress is not None else None
+        engine_pool = self.engine_pool(engine_type)
+        engine = engine_pool.checkout()
+        try:
+            with span("engine_search"):
+                return engine.analyze(board, limit, multi_pv, new_game=self.new_game, root_moves=root_moves, on_info=on_info)
+        except (chess.engine.EngineError, chess.engine.EngineTerminatedError):
+            print(f"💥 {engine_type} engine crashed while analysing {board.fen()!r}, restarting.")
+            crashed, engine = engine, None
+            engine = engine_pool.restart(crashed)
+            try:
+                return engine.analyze(board, limit, multi_pv, new_game=True, root_moves=root_moves, on_info=on_info)
+            except (chess.engine.EngineError, chess.engine.EngineTerminatedError):
+                # Crashed again on a fresh process, the engine is not put back into rotation.
+                broken, engine = engine, None
+                engine_pool.discard(broken)
+                raise
+        finally:
+            if engine is not None:
+                engine_pool.checkin(engine)
+
+    def submit_job(
+        self,
+        uci: str,
+        engine_type: str,
+        limit: AnalysisLimit | float,
+        multi_pv: int,
+        speculative: bool = False,
+        root_moves: list[str] | None = None,
+        group: str | None = None,
+        board: chess.Board | None = None,
+    ) -> str:
+        limit = AnalysisLimit.of(limit)
+        id = self.job_id(uci, engine_type, multi_pv, root_moves, limit)
+        progress = Progress()
+
+        def start() -> Future:
+            with self._counters_lock:
+                self._queued += 1
+            # A requested search runs in the request's context, so its engine spans land in the request trace. Speculation
+            # outlives the request and is left out.
+            job = (self._run_analysis, uci, engine_type, limit, multi_pv, root_moves, board, progress)
+            future = self.executor.submit(*job) if speculative else self.executor.submit(contextvars.copy_context().run, *job)
+            future.add_done_callback(self._job_done)
+            future.add_done_callback(lambda _: progress.finish())
+            return future
+
+        reused = self._jobs.submit(id, start, speculative=speculative, group=group, progress=progress)
+        if reused:
             print(f"Job for {uci} already submitted. Reusing job.")
-            return id
-        print(f"Job {uci} is submitted.")
-        self._futures[id] = self.executor.submit(self._run_analysis, uci, engine_type, time_limit, multi_pv)
+        else:
+            print(f"Job {uci} is submitted.")
 
         return id
 
+    def _job_done(self, future: Future):
+        # Jobs cancelled while queued never ran.
+        if future.cancelled():
+            with self._counters_lock:
+                self._queued -= 1
+
     def get_result(self, id: str) -> list[dict]:
-        future = self._futures.pop(id, None)
-        if not future:
-            raise KeyError(f"Job ID '{id}' not found or already retrieved.")
+        try:
+            future = self._jobs.claim(id)
+        except KeyError:
+            raise KeyError(f"Job ID '{id}' not found or already retrieved.") from None
 
         result = future.result()
         return result
 
-    def submit_and_get(self, uci: str, engine_type: str, time_limit: int, multi_pv: int) -> list[dict]:
-        id = self.submit_job(uci, engine_type=engine_type, time_limit=time_limit, multi_pv=multi_pv)
+    def progress(self, id: str, after: int = 0, timeout: float = 1.0) -> tuple[int, list[dict] | None, bool]:
+        # Waits for lines newer than version `after` without claiming the job: (version, lines, done).
+        job = self._jobs.get(id)
+        if job is None:
+            raise KeyError(f"Job ID '{id}' not found or already retrieved.")
+        version, lines = job.progress.wait(after, timeout)
+        return version, lines, job.future.done()
+
+    def cancel_job(self, id: str) -> bool:
+        return self._jobs.cancel(id)
+
+    def release_job(self, id: str) -> bool:
+        return self._jobs.release(id)
+
+    def cancel_group(self, group: str, keep: tuple[str, ...] = ()) -> int:
+        return self._jobs.cancel_group(group, keep)
+
+    def metrics(self) -> dict[str, dict]:
+        with self._engine_pools_lock:
+            engine_pools = dict(self._engine_pools)
+        metrics = {engine_type: engine_pool.metrics() for engine_type, engine_pool in engine_pools.items()}
+        metrics["jobs"] = self._jobs.metrics()
+        with self._counters_lock:
+            metrics["queue"] = {"queued": self._queued, "running": self._running, "workers": self.num_workers}
+        if self.eval_cache is not None:
+            metrics["eval_cache"] = self.eval_cache.metrics()
+        return metrics
+
+    def submit_and_get(self, uci: str, engine_type: str, limit: AnalysisLimit | float, multi_pv: int) -> list[dict]:
+        id = self.submit_job(uci, engine_type=engine_type, limit=limit, multi_pv=multi_pv)
         return self.get_result(id)
 
     def shutdown(self):
         print("Shutting down the thread pool. Waiting for active jobs to finish...")
+        self._jobs.clear()
         self.executor.shutdown(wait=True)
+        for engine_pool in self._engine_pools.values():
+            engine_pool.close()
+        if self.eval_cache is not None:
+            self.eval_cache.close()
         print("All workers have been shut down.")
 
     def __enter__(self):
@@ -1,57 +1,111 @@
+from typing import Iterator
 from typing import Tuple
 
+import chess
+
 from dmemo.engine import ChessAnalysisPool
+from dmemo.limits import AnalysisLimit
+from dmemo.metrics import span
 from dmemo.utils import previous_move_and_uci
 from dmemo.utils import uci2board
 
 
+def speculation_group(uci: str, owner: str | None = None) -> str:
+    # Speculation belongs to the session that asked for it, another session at the same position must not cancel it.
+    return f"{owner}|{uci}" if owner else uci
+
+
 class Evaluator:
     def __init__(
         self,
         pool: ChessAnalysisPool,
         uci: str,
         engine_type: str,
-        move_limit: int,
+        move_limit: AnalysisLimit | float,
         n_hints: int,
         instant: bool = False,
+        board: chess.Board | None = None,
+        owner: str | None = None,
     ):
         self.pool = pool
         self.uci = uci
         self.engine_type = engine_type
         self.move_limit = move_limit
         self.n_hints = n_hints
+        self.owner = owner
 
-        _, self.prev_uci = previous_move_and_uci(uci)
-        self.pov = uci2board(self.prev_uci).turn
+        self.move, self.prev_uci = previous_move_and_uci(uci)
+        if board is not None and board.move_stack:
+            self.prev_board = board.copy()
+            self.prev_board.pop()
+        else:
+            self.prev_board = uci2board(self.prev_uci)
+        self.pov = self.prev_board.turn
 
-        self.ids = []
+        self.best_moves_id = None
+        self.move_id = None
 
         if instant:
             self.submit_jobs()
 
-    def submit_jobs_in_advance(self, uci: str):
-        # Best moves (hints)
-        self.pool.submit_job(uci, self.engine_type, self.move_limit, self.n_hints)
-        # Base score for the next move
-        self.pool.submit_job(uci, self.engine_type, time_limit=self.move_limit, multi_pv=1)
+    def submit_jobs_in_advance(self, uci: str, board: chess.Board | None = None):
+        # Best moves (hints), the top line is also the base score for the next move
+        self.pool.submit_job(uci, self.engine_type, self.move_limit, self.n_hints, speculative=True, board=board)
+
+    def submit_replies_in_advance(self, uci: str, replies: list[str], board: chess.Board | None = None):
+        # Likely replies outside the hints are scored by a search restricted to that move, start those early.
+        for reply in replies:
+            self.pool.submit_job(
+                uci,
+                self.engine_type,
+                self.move_limit,
+                1,
+                speculative=True,
+                root_moves=[reply],
+                group=speculation_group(uci, self.owner),
+                board=board,
+            )
 
     def submit_jobs(self):
-        best_moves_id = self.pool.submit_job(self.prev_uci, self.engine_type, self.move_limit, self.n_hints)
-        prev_id = self.pool.submit_job(self.prev_uci, self.engine_type, time_limit=self.move_limit, multi_pv=1)
-        curr_id = self.pool.submit_job(self.uci, self.engine_type, time_limit=self.move_limit, multi_pv=1)
-        self.ids = (best_moves_id, prev_id, curr_id)
+        self.best_moves_id = self.pool.submit_job(
+            self.prev_uci,
+            self.engine_type,
+            self.move_limit,
+            self.n_hints,
+            board=self.prev_board,
+        )
+        # The actual move is known now, the remaining speculative replies are no longer needed. A speculative search of
+        # the move itself is kept, it answers move_score if the hints miss the move.
+        move_job = self.pool.job_id(self.prev_uci, self.engine_type, 1, [self.move], self.move_limit)
+        self.pool.cancel_group(speculation_group(self.prev_uci, self.owner), keep=(move_job,))
 
-    def result(self) -> Tuple[float, list[tuple[str, float]]]:
-        best_moves_id, prev_id, curr_id = self.ids
-        prev_state = self.pool.get_result(prev_id)
-        curr_state = self.pool.get_result(curr_id)
+    def hinted_score(self, best_moves: list[dict]) -> float | None:
+        for line in best_moves:
+            if str(line["pv"][0]) == self.move:
+                return line["score"].pov(self.pov).score()
+        return None
 
-        prev_score = prev_state[0]["score"].pov(self.pov).score()
-        curr_score = curr_state[0]["score"].pov(self.pov).score()
+    def submit_move_job(self):
+        # The move is not among the hints, search only this move from the previous position.
+        self.move_id = self.pool.submit_job(
+            self.prev_uci,
+            self.engine_type,
+            self.move_limit,
+            1,
+            root_moves=[self.move],
+            board=self.prev_board,
+        )
 
-        best_moves = self.pool.get_result(best_moves_id)
+    def move_score(self, best_moves: list[dict]) -> float:
+        score = self.hinted_score(best_moves)
+        if score is not None:
+            return score
+        self.submit_move_job()
+        return self.pool.get_result(self.claim("move_id"))[0]["score"].pov(self.pov).score()
 
-        best_moves = [
+    def hints(self, best_moves: list[dict]) -> list[tuple[str, float]]:
+        prev_score = best_moves[0]["score"].pov(self.pov).score()
+        return [
             (
                 str(move["pv"][0]),
                 min(move["score"].pov(self.pov).score() - prev_score, 0),
@@ -59,4 +113,37 @@ class Evaluator:
             for move in best_moves
         ]
 
-        return min(curr_score - prev_score, 0), best_moves
+    def updates(self, timeout: float = 1.0) -> Iterator[tuple[int | None, float | None, list[tuple[str, float]]]]:
+        # Depth, diff (while the move is among the hints) and hints of every depth the running search completes.
+        seen = 0
+        while True:
+            version, lines, done = self.pool.progress(self.best_moves_id, seen, timeout)
+            lines = [line for line in lines or [] if line.get("pv") and line.get("score") is not None]
+            if version > seen and lines:
+                seen = version
+                hints = self.hints(lines)
+                yield lines[0].get("depth"), dict(hints).get(self.move), hints
+            if done:
+                return
+
+    def claim(self, name: str) -> str:
+        # A claimed job is no longer held, so cancel never releases a reference twice.
+        id = getattr(self, name)
+        setattr(self, name, None)
+        return id
+
+    def cancel(self):
+        # Other requests may share these searches, they only stop once nobody holds them anymore.
+        if self.best_moves_id is not None:
+            self.pool.release_job(self.best_moves_id)
+        if self.move_id is not None:
+            self.pool.release_job(self.move_id)
+
+    def result(self) -> Tuple[float, list[tuple[str, float]]]:
+        with span("evaluator"):
+            best_moves = self.pool.get_result(self.claim("best_moves_id"))
+
+            prev_score = best_moves[0]["score"].pov(self.pov).score()
+            curr_score = self.move_score(best_moves)
+
+        return min(curr_score - prev_score, 0), self.hints(best_moves)
@@ -0,0 +1,111 @@
+from collections import OrderedDict
+import threading
+
+import chess
+import diskcache as dc
+
+from dmemo.limits import AnalysisLimit
+
+INFO_KEYS = ("score", "pv", "depth", "seldepth", "nodes", "time", "multipv", "wdl")
+
+
+def make_entry(lines: list[dict], multi_pv: int, limit: AnalysisLimit) -> dict:
+    # What the search actually reached, so depth or node limited results can also serve time limited lookups.
+    depth = min((line.get("depth", 0) for line in lines), default=0)
+    nodes = min((line.get("nodes", 0) for line in lines), default=0)
+    reached = max((line.get("time", 0.0) for line in lines), default=0.0)
+    # The whole time limit is credited only when nothing else could have ended the search, adaptive searches may have
+    # stopped early and depth or node limits may have been met first.
+    other_limit_met = (limit.depth is not None and depth >= limit.depth) or (limit.nodes is not None and nodes >= limit.nodes)
+    entry = {
+        "lines": [{key: line[key] for key in INFO_KEYS if key in line} for line in lines],
+        "multi_pv": multi_pv,
+        "time": reached if limit.stable_depths or other_limit_met else max(limit.time or 0.0, reached),
+        "depth": depth,
+        "nodes": nodes,
+    }
+    if limit.stable_depths:
+        entry["stable_depths"] = limit.stable_depths
+        entry["stable_time"] = limit.time
+    return entry
+
+
+def satisfies(entry: dict, multi_pv: int, limit: AnalysisLimit) -> bool:
+    if entry["multi_pv"] < multi_pv:
+        return False
+    # The same adaptive search with at least as much time would have stopped no earlier.
+    if limit.stable_depths and entry.get("stable_depths", 0) >= limit.stable_depths and (entry.get("stable_time") or 0.0) >= (limit.time or 0.0):
+        return True
+    # A search ends at whichever of its limits comes first, an entry that went as far as one of them answers it.
+    bounds = [(limit.time, entry["time"]), (limit.depth, entry["depth"]), (limit.nodes, entry.get("nodes", 0))]
+    bounds = [(wanted, reached) for wanted, reached in bounds if wanted is not None]
+    return not bounds or any(reached >= wanted for wanted, reached in bounds)
+
+
+class EvalCache:
+    def __init__(self, cache_path: str | None = None, memory_size: int = 10_000):
+        self.memory_size = memory_size
+        self.memory: OrderedDict[str, dict] = OrderedDict()
+        self.disk = dc.Cache(cache_path) if cache_path else None
+        self._lock = threading.Lock()
+
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def key(board: chess.Board, engine_type: str, options: dict | None = None, root_moves: list[str] | None = None) -> str:
+        options_key = ",".join(f"{name}={value}" for name, value in sorted((options or {}).items()))
+        key = f"{engine_type}|{options_key}|{board.epd()}"
+        return f"{key}|{','.join(sorted(root_moves))}" if root_moves else key
+
+    def _remember(self, key: str, entry: dict):
+        self.memory[key] = entry
+        self.memory.move_to_end(key)
+        while len(self.memory) > self.memory_size:
+            self.memory.popitem(last=False)
+
+    def get(self, key: str, multi_pv: int, limit: AnalysisLimit) -> list[dict] | None:
+        with self._lock:
+            entry = self.memory.get(key)
+            if entry is not None and satisfies(entry, multi_pv, limit):
+                self.memory.move_to_end(key)
+                self.memory_hits += 1
+                return entry["lines"][:multi_pv]
+
+        entry = self.disk.get(key) if self.disk is not None else None
+        with self._lock:
+            if entry is not None and satisfies(entry, multi_pv, limit):
+                self._remember(key, entry)
+                self.disk_hits += 1
+                return entry["lines"][:multi_pv]
+            self.misses += 1
+        return None
+
+    def put(self, key: str, lines: list[dict], multi_pv: int, limit: AnalysisLimit):
+        entry = make_entry(lines, multi_pv, limit)
+        with self._lock:
+            current = self.memory.get(key)
+            if current is not None and satisfies(current, multi_pv, limit):
+                return
+            self._remember(key, entry)
+        if self.disk is not None:
+            current = self.disk.get(key)
+            if current is None or not satisfies(current, multi_pv, limit):
+                self.disk[key] = entry
+
+    def metrics(self) -> dict:
+        with self._lock:
+            hits = self.memory_hits + self.disk_hits
+            lookups = hits + self.misses
+            return {
+                "memory_hits": self.memory_hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "hit_ratio": hits / lookups if lookups else 0.0,
+                "memory_size": len(self.memory),
+            }
+
+    def close(self):
+        if self.disk is not None:
+            self.disk.close()
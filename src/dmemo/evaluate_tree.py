@@ -0,0 +1,146 @@
+import argparse
+from collections import deque
+import os
+import time
+
+from dotenv import load_dotenv
+import tqdm
+
+from dmemo.engine import ENGINES
+from dmemo.engine import ChessAnalysisPool
+from dmemo.evalcache import EvalCache
+from dmemo.explorer import Explorer
+from dmemo.limits import AnalysisLimit
+
+load_dotenv()
+
+
+def evaluate_tree(
+    explorer: Explorer,
+    pool: ChessAnalysisPool,
+    engine_type: str,
+    depth: int,
+    limit: AnalysisLimit,
+    multi_pv: int,
+    n_hints: int = 3,
+    max_in_flight: int | None = None,
+) -> dict[str, float]:
+    # Positions already in the eval cache resolve without an engine, so reruns only analyse what is new or too shallow.
+    max_in_flight = max_in_flight or pool.num_workers * 2
+    in_flight = deque()
+    start = time.perf_counter()
+    positions = 0
+    moves = 0
+
+    pbar = tqdm.tqdm(desc="🔬 Evaluating tree", unit="searches")
+
+    def collect():
+        nonlocal positions, moves
+        id, uci, tree_moves = in_flight.popleft()
+        lines = pool.get_result(id)
+        pbar.update(1)
+        if tree_moves is None:
+            moves += 1
+            return
+        positions += 1
+        # A played move outside the hints is scored by a search restricted to that move, those are cached too.
+        hinted = {str(line["pv"][0]) for line in lines[:n_hints] if line.get("pv")}
+        for move in tree_moves:
+            if move not in hinted:
+                in_flight.append((pool.submit_job(uci, engine_type, limit, 1, root_moves=[move]), uci, None))
+
+    for uci, tree_moves in explorer.walk_cache(depth, unique_positions=True):
+        in_flight.append((pool.submit_job(uci, engine_type, limit, multi_pv), uci, tree_moves))
+        while len(in_flight) >= max_in_flight:
+            collect()
+    while in_flight:
+        collect()
+    pbar.close()
+
+    elapsed = time.perf_counter() - start
+    cache = pool.eval_cache.metrics() if pool.eval_cache is not None else {}
+    stats = {
+        "positions": positions,
+        "moves": moves,
+        "cached": cache.get("memory_hits", 0) + cache.get("disk_hits", 0),
+        "analysed": cache.get("misses", positions + moves),
+        "seconds": elapsed,
+    }
+    print(
+        f"✅ Evaluated {positions} positions and {moves} moves outside the hints in {elapsed:.1f}s "
+        f"({stats['analysed']} analysed, {stats['cached']} already cached)."
+    )
+    return stats
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Pre-compute engine evaluations for every position of the cached opening tree.",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    parser.add_argument(
+        "--engine-type",
+        choices=list(ENGINES),
+        default="stockfish",
+        help="Engine used for the analysis.",
+    )
+    parser.add_argument(
+        "--depth",
+        type=int,
+        default=10,
+        help="Depth of the cached tree to walk.",
+    )
+    parser.add_argument(
+        "--engine-depth",
+        type=int,
+        default=None,
+        help="Search depth per position.",
+    )
+    parser.add_argument(
+        "--engine-time",
+        type=float,
+        default=None,
+        help="Search time per position in seconds, results also serve live requests with a move time up to this.",
+    )
+    parser.add_argument(
+        "--multi-pv",
+        type=int,
+        default=5,
+        help="Number of lines per position, should be at least the number of hints.",
+    )
+    parser.add_argument(
+        "--hints",
+        type=int,
+        default=3,
+        help="Number of hints the app shows, tree moves outside them also get a search of their own.",
+    )
+    parser.add_argument(
+        "--num-workers",
+        type=int,
+        default=os.cpu_count(),
+        help="Number of engines running in parallel.",
+    )
+    parser.add_argument(
+        "--transpositions",
+        action="store_true",
+        default=os.environ.get("EXPLORER_TRANSPOSITIONS") == "1",
+        help="The explorer cache is keyed by position hash.",
+    )
+    args = parser.parse_args()
+
+    if args.engine_depth is None and args.engine_time is None:
+        parser.error("Pass --engine-depth and/or --engine-time.")
+    if not os.environ.get("EVAL_CACHE_PATH"):
+        parser.error("Set EVAL_CACHE_PATH, the evaluations are stored there.")
+
+    explorer = Explorer(os.environ.get("EXPLORER_CACHE_PATH"), transpositions=args.transpositions)
+    pool = ChessAnalysisPool(
+        num_workers=args.num_workers,
+        eval_cache=EvalCache(os.environ.get("EVAL_CACHE_PATH")),
+    )
+    limit = AnalysisLimit(time=args.engine_time, depth=args.engine_depth)
+    try:
+        evaluate_tree(explorer, pool, args.engine_type, args.depth, limit, args.multi_pv, args.hints)
+    finally:
+        pool.shutdown()
+        explorer.shutdown()
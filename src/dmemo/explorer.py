@@ -1,84 +1,350 @@
 import argparse
+from collections import defaultdict
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED
+from concurrent.futures import Future
 from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import wait
 import os
+import queue
+import threading
+import time
+from typing import Iterator
 
+import chess
 import diskcache as dc
 from dotenv import load_dotenv
 import tqdm
 
+from dmemo import metrics
+from dmemo.buckets import SPEEDS
+from dmemo.buckets import select_buckets
 from dmemo.db import crud
+from dmemo.jobs import JobRegistry
+from dmemo.openingbook import OpeningBook
+from dmemo.openingbook import export_explorer_cache
+from dmemo.openingbook import write_book
+from dmemo.utils import position_key
+from dmemo.utils import uci2board
 
 load_dotenv()
 
 
+def use_positions(uci: str, transpositions: bool) -> bool:
+    return transpositions and len(uci.split()) < crud.OPENING_TREE_DEPTH
+
+
+def cache_key(uci: str, buckets: tuple[int, ...] | None = None, board: chess.Board | None = None, transpositions: bool = False) -> str:
+    if use_positions(uci, transpositions):
+        key = f"z:{position_key(board if board is not None else uci2board(uci))}"
+    else:
+        key = uci
+    if buckets is not None:
+        key = f"{key}|b:{','.join(map(str, sorted(buckets)))}"
+    return key
+
+
 class Explorer:
-    def __init__(self, cache_path: str, num_workers: int = 2):
+    def __init__(
+        self,
+        cache_path: str,
+        num_workers: int = 2,
+        transpositions: bool = False,
+        batch_size: int = 64,
+        batch_window: float = 0.002,
+        book_path: str | None = None,
+        job_ttl: float = 300.0,
+        max_jobs: int = 1024,
+    ):
+        self.num_workers = num_workers
         self.executor = ThreadPoolExecutor(max_workers=num_workers, thread_name_prefix="ExplorerWorker")
         self.cache = dc.Cache(cache_path)
-        self.futures = {}
-
-    def _explore(self, uci):
-        if uci in self.cache:
-            return self.cache[uci]
-        moves = crud.get_next_move_distribution(uci)
-        self.cache[uci] = moves
-        return moves
-
-    def submit_job(self, uci: str) -> None:
-        future = self.executor.submit(self._explore, uci)
-        self.futures[uci] = future
-
-    def get_result(self, uci: str) -> dict[str, int]:
-        future = self.futures.pop(uci, None)
-        if not future:
-            raise KeyError(f"UCI '{uci}' not found or already retrieved.")
+        self.jobs = JobRegistry(ttl=job_ttl, max_jobs=max_jobs)
+        self.transpositions = transpositions
+        # The memory-mapped book is shared through the page cache and answers unfiltered lookups first.
+        self.book = OpeningBook(book_path) if book_path and os.path.exists(book_path) else None
+
+        # Cache misses are queued and resolved in batches, one query per batch instead of one per position.
+        self.batch_size = batch_size
+        self.batch_window = batch_window
+        self._misses = queue.Queue()
+        self._pending: dict[str, Future] = {}
+        self._pending_lock = threading.Lock()
+        self._busy = 0
+        self.lookups = {"book_hits": 0, "cache_hits": 0, "misses": 0}
+        self._dispatcher = threading.Thread(target=self._dispatch, name="ExplorerDispatcher", daemon=True)
+        self._dispatcher.start()
+
+    def _use_positions(self, uci: str) -> bool:
+        return use_positions(uci, self.transpositions)
+
+    def cache_key(self, uci: str, buckets: tuple[int, ...] | None = None, board: chess.Board | None = None) -> str:
+        return cache_key(uci, buckets, board, self.transpositions)
+
+    def _lookup(self, uci: str, buckets: tuple[int, ...] | None = None, board: chess.Board | None = None) -> Future:
+        # The book is keyed by position, it only stands in for lookups that are keyed by position as well.
+        if self.book is not None and buckets is None and self._use_positions(uci):
+            board = board if board is not None else uci2board(uci)
+            moves = self.book.get(board)
+        else:
+            moves = None
+        key = self.cache_key(uci, buckets, board)
+        if moves:
+            hit = "book_hits"
+        else:
+            moves = self.cache.get(key)
+            hit = "cache_hits" if moves is not None else "misses"
+        with self._pending_lock:
+            self.lookups[hit] += 1
+        if moves is not None:
+            future = Future()
+            future.set_result(moves)
+            return future
+
+        with self._pending_lock:
+            future = self._pending.get(key)
+            # A cancelled lookup must not answer later ones, it is replaced and queued again.
+            if future is not None and not future.cancelled():
+                return future
+            future = self._pending[key] = Future()
+        # The batch is resolved on another thread, the trace travels with the miss.
+        self._misses.put((key, uci, buckets, metrics.current_trace(), future))
+        return future
+
+    def _dispatch(self):
+        while True:
+            miss = self._misses.get()
+            if miss is None:
+                return
+            batch = [miss]
+            deadline = time.monotonic() + self.batch_window
+            while len(batch) < self.batch_size:
+                try:
+                    miss = self._misses.get(timeout=max(0.0, deadline - time.monotonic()))
+                except queue.Empty:
+                    break
+                if miss is None:
+                    self._misses.put(None)
+                    break
+                batch.append(miss)
+            # Lookups cancelled while queued do not take up a batch slot or a worker.
+            batch = [miss for miss in batch if not self._drop_cancelled(miss[0], miss[4])]
+            if batch:
+                self.executor.submit(self._resolve_batch, batch)
+
+    def _drop_cancelled(self, key: str, future: Future) -> bool:
+        if not future.cancelled():
+            return False
+        with self._pending_lock:
+            if self._pending.get(key) is future:
+                del self._pending[key]
+        return True
+
+    def _query_batch(self, ucis: list[str], buckets: tuple[int, ...] | None, positions: bool) -> list[dict[str, int]]:
+        if positions:
+            hashes = [position_key(uci2board(uci)) for uci in ucis]
+            distributions = crud.get_position_move_distributions(list(set(hashes)), buckets)
+            return [distributions[parent_hash] for parent_hash in hashes]
+        distributions = crud.get_next_move_distributions(ucis, buckets)
+        return [distributions[uci] for uci in ucis]
+
+    def _resolve_batch(self, batch: list[tuple[str, str, tuple[int, ...] | None, metrics.Trace | None, Future]]):
+        with self._pending_lock:
+            self._busy += 1
+        try:
+            self._resolve_misses(batch)
+        finally:
+            with self._pending_lock:
+                self._busy -= 1
+
+    def _resolve_misses(self, batch: list[tuple[str, str, tuple[int, ...] | None, metrics.Trace | None, Future]]):
+        groups = defaultdict(list)
+        traces = defaultdict(list)
+        running: list[tuple[str, Future]] = []
+        try:
+            for key, uci, buckets, trace, future in batch:
+                # Lookups cancelled after dispatch are dropped from the batch as well.
+                if not future.set_running_or_notify_cancel():
+                    self._drop_cancelled(key, future)
+                    continue
+                running.append((key, future))
+                group = (buckets, self._use_positions(uci))
+                groups[group].append((key, uci, future))
+                if trace is not None:
+                    traces[group].append(trace)
+
+            for (buckets, positions), misses in groups.items():
+                try:
+                    with metrics.shared_spans(traces[(buckets, positions)]):
+                        results = self._query_batch([uci for _, uci, _ in misses], buckets, positions)
+                except Exception as e:
+                    results = None
+                    error = e
+
+                # Waiters are answered before the cache write, a failing write must not leave them hanging.
+                for i, (key, _, future) in enumerate(misses):
+                    with self._pending_lock:
+                        self._pending.pop(key, None)
+                    if results is None:
+                        future.set_exception(error)
+                    else:
+                        future.set_result(results[i])
+                if results is not None:
+                    try:
+                        for i, (key, _, _) in enumerate(misses):
+                            self.cache[key] = results[i]
+                    except Exception as e:
+                        print(f"Writing the explorer cache failed: {e}")
+        finally:
+            for key, future in running:
+                if future.done():
+                    continue
+                with self._pending_lock:
+                    if self._pending.get(key) is future:
+                        del self._pending[key]
+                future.set_exception(RuntimeError(f"Explorer lookup for '{key}' was not resolved."))
+
+    def submit_job(
+        self,
+        uci: str,
+        buckets: tuple[int, ...] | None = None,
+        speculative: bool = False,
+        board: chess.Board | None = None,
+    ) -> None:
+        self.jobs.submit((uci, buckets), lambda: self._lookup(uci, buckets, board), speculative=speculative)
+
+    def get_result(self, uci: str, buckets: tuple[int, ...] | None = None) -> dict[str, int]:
+        try:
+            future = self.jobs.claim((uci, buckets))
+        except KeyError:
+            raise KeyError(f"UCI '{uci}' not found or already retrieved.") from None
         return future.result()
 
-    def submit_and_get(self, uci: str) -> dict[str, int]:
-        self.submit_job(uci)
-        return self.get_result(uci)
+    def submit_and_get(self, uci: str, buckets: tuple[int, ...] | None = None, board: chess.Board | None = None) -> dict[str, int]:
+        self.submit_job(uci, buckets, board=board)
+        return self.get_result(uci, buckets)
+
+    def metrics(self) -> dict:
+        with self._pending_lock:
+            lookups = dict(self.lookups)
+            pending, busy = len(self._pending), self._busy
+        hits = lookups["book_hits"] + lookups["cache_hits"]
+        total = hits + lookups["misses"]
+        return {
+            "queued": self._misses.qsize(),
+            "pending": pending,
+            "busy": busy,
+            "workers": self.num_workers,
+            "lookups": lookups,
+            "hit_ratio": hits / total if total else 0.0,
+            "jobs": self.jobs.metrics(),
+        }
 
-    def _recursive_explore(
+    def explore(
         self,
         uci: str,
         depth: int,
-        max_depth: int,
         stop_threshold: float,
-        pbar: tqdm.tqdm,
-    ):
-        dst = self.get_result(uci)
-        pbar.update(1)
-        total = sum(dst.values())
-        if total == 0:
-            return
+        buckets: tuple[int, ...] | None = None,
+        max_in_flight: int | None = None,
+    ) -> dict[str, float]:
+        # Bounded work queue: children are queued as soon as their parent resolves, and concurrent misses share batches.
+        # Positions already in the cache are expanded without a DB round trip, which also makes reruns resume cheaply.
+        max_in_flight = max_in_flight or self.num_workers * 4
+        nodes = deque([(uci, 0)])
+        in_flight: dict[Future, list[tuple[str, int]]] = {}
+        stats = {"positions": 0, "cached": 0, "queried": 0}
 
-        if depth + 1 > max_depth:
-            return
+        pbar = tqdm.tqdm(desc="🧭 Exploring", unit="positions")
+        start = time.perf_counter()
 
-        for move, count in dst.items():
-            if count / total < stop_threshold:
-                continue
-            new_uci = f"{uci} {move}" if uci else move
-            self.submit_job(new_uci)
-            self._recursive_explore(new_uci, depth + 1, max_depth, stop_threshold, pbar)
+        def expand(parent_uci: str, parent_depth: int, dst: dict[str, int]):
+            stats["positions"] += 1
+            pbar.update(1)
+            total = sum(dst.values())
+            if total == 0 or parent_depth + 1 > depth:
+                return
+            for move, count in dst.items():
+                if count / total >= stop_threshold:
+                    nodes.append((f"{parent_uci} {move}" if parent_uci else move, parent_depth + 1))
 
-    def explore(self, uci: str, depth: int, stop_threshold: float) -> dict[str, int]:
-        self.submit_job(uci)
+        while nodes or in_flight:
+            while nodes and len(in_flight) < max_in_flight:
+                node_uci, node_depth = nodes.popleft()
+                future = self._lookup(node_uci, buckets)
+                if future.done():
+                    stats["cached"] += 1
+                    expand(node_uci, node_depth, future.result())
+                    continue
+                in_flight.setdefault(future, []).append((node_uci, node_depth))
+
+            if in_flight:
+                done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                for future in done:
+                    for node_uci, node_depth in in_flight.pop(future):
+                        stats["queried"] += 1
+                        expand(node_uci, node_depth, future.result())
+
+            pbar.set_postfix(cached=stats["cached"], queried=stats["queried"])
 
-        pbar = tqdm.tqdm(desc="🧭 Exploring", unit="positions")
-        self._recursive_explore(uci, 0, depth, stop_threshold, pbar)
         pbar.close()
+        elapsed = time.perf_counter() - start
+        stats["seconds"] = elapsed
+        stats["positions_per_second"] = stats["positions"] / elapsed if elapsed else 0.0
+        print(
+            f"✅ Explored {stats['positions']} positions in {elapsed:.1f}s "
+            f"({stats['positions_per_second']:.0f}/s, {stats['cached']} cached, {stats['queried']} queried)."
+        )
+        return stats
+
+    def walk_cache(
+        self,
+        depth: int,
+        buckets: tuple[int, ...] | None = None,
+        unique_positions: bool = False,
+    ) -> Iterator[tuple[str, dict[str, int]]]:
+        # Breadth-first over the cached tree only, never touches the database.
+        seen = set()
+        nodes = deque([("", 0)])
+        while nodes:
+            uci, node_depth = nodes.popleft()
+            moves = self.cache.get(self.cache_key(uci, buckets))
+            if moves is None:
+                continue
+            if unique_positions:
+                key = position_key(uci2board(uci))
+                if key in seen:
+                    continue
+                seen.add(key)
+            yield uci, moves
+            if node_depth < depth:
+                nodes.extend((f"{uci} {move}" if uci else move, node_depth + 1) for move in moves)
 
     def shutdown(self):
         print("Shutting down the thread pool. Waiting for active jobs to finish...")
+        self.jobs.clear()
+        self._misses.put(None)
+        self._dispatcher.join()
+        if self.book is not None:
+            self.book.close()
         self.executor.shutdown(wait=True)
         print("All workers have been shut down.")
 
 
-def explore(depth: int, num_workers: int, stop_threshold: float) -> dict[str, int]:
-    explorer = Explorer(os.environ.get("EXPLORER_CACHE_PATH"), num_workers)
-    explorer.explore("", depth, stop_threshold)
+def explore(
+    depth: int,
+    num_workers: int,
+    stop_threshold: float,
+    transpositions: bool,
+    buckets: tuple[int, ...] | None = None,
+    book_path: str | None = None,
+) -> dict[str, int]:
+    explorer = Explorer(os.environ.get("EXPLORER_CACHE_PATH"), num_workers, transpositions)
+    stats = explorer.explore("", depth, stop_threshold, buckets)
+    if book_path:
+        write_book(book_path, export_explorer_cache(explorer, depth))
     explorer.shutdown()
+    return stats
 
 
 if __name__ == "__main__":
@@ -104,6 +370,39 @@ if __name__ == "__main__":
         default=0.05,
         help="Minimum ratio of occurances to continue exploration.",
     )
+    parser.add_argument(
+        "--transpositions",
+        action="store_true",
+        default=os.environ.get("EXPLORER_TRANSPOSITIONS") == "1",
+        help="Look up distributions by position hash so transpositions share statistics.",
+    )
+    parser.add_argument(
+        "--rating-min",
+        type=int,
+        default=None,
+        help="Only count moves played by players rated at least this much.",
+    )
+    parser.add_argument(
+        "--rating-max",
+        type=int,
+        default=None,
+        help="Only count moves played by players rated below this.",
+    )
+    parser.add_argument(
+        "--speeds",
+        nargs="+",
+        choices=SPEEDS,
+        default=None,
+        help="Only count moves from games of these speed classes.",
+    )
+    parser.add_argument(
+        "--export-book",
+        default=None,
+        help="Compile the explored tree into a memory-mapped opening book at this path.",
+    )
     args = parser.parse_args()
+    if args.export_book and (args.rating_min is not None or args.rating_max is not None or args.speeds):
+        parser.error("--export-book compiles unfiltered statistics, it cannot be combined with --rating-min, --rating-max or --speeds.")
 
-    explore(args.depth, args.num_workers, args.stop_threshold)
+    buckets = select_buckets(args.rating_min, args.rating_max, args.speeds)
+    explore(args.depth, args.num_workers, args.stop_threshold, args.transpositions, buckets, args.export_book)
@@ -0,0 +1,208 @@
+from collections import OrderedDict
+from concurrent.futures import Future
+from dataclasses import dataclass
+from dataclasses import field
+import threading
+import time
+from typing import Any
+from typing import Callable
+from typing import Hashable
+
+
+class Progress:
+    # Latest partial result of a running job, for callers that want updates before it finishes.
+    def __init__(self):
+        self.version = 0
+        self.snapshot = None
+        self.done = False
+        self.stopped = False
+        self.started = False
+        self._changed = threading.Condition()
+
+    def start(self):
+        # Marks a job whose search got an engine, from then on it is no longer cancelled, only stopped.
+        self.started = True
+
+    def publish(self, snapshot: Any) -> bool:
+        # Returns false once the job was stopped, the worker should then wrap up.
+        with self._changed:
+            self.version += 1
+            self.snapshot = snapshot
+            self._changed.notify_all()
+            return not self.stopped
+
+    def finish(self):
+        with self._changed:
+            self.done = True
+            self._changed.notify_all()
+
+    def stop(self):
+        with self._changed:
+            self.stopped = True
+            self._changed.notify_all()
+
+    def wait(self, after: int, timeout: float) -> tuple[int, Any]:
+        with self._changed:
+            self._changed.wait_for(lambda: self.version > after or self.done or self.stopped, timeout)
+            return self.version, self.snapshot
+
+
+@dataclass
+class Job:
+    future: Future
+    refs: int
+    expires: float
+    groups: set[Hashable] = field(default_factory=set)
+    progress: Progress | None = None
+    claimed: bool = False
+
+
+class JobRegistry:
+    # Jobs shared by key. Every non-speculative submit holds a reference that `claim` releases. Speculative jobs hold none
+    # and stay around only until their TTL runs out or the size bound pushes them out. Referenced jobs outlive the TTL, up
+    # to `referenced_ttl`, after which a caller that never claimed them is assumed gone.
+    def __init__(self, ttl: float = 300.0, max_jobs: int = 1024, referenced_ttl: float = 3600.0):
+        self.ttl = ttl
+        self.referenced_ttl = max(referenced_ttl, ttl)
+        self.max_jobs = max_jobs
+        self._jobs: OrderedDict[Hashable, Job] = OrderedDict()
+        self._lock = threading.Lock()
+
+        self.reused = 0
+        self.expired = 0
+        self.evicted = 0
+        self.cancelled = 0
+
+    def _drop(self, key: Hashable) -> Job:
+        job = self._jobs.pop(key)
+        if job.claimed or job.future.done():
+            # Somebody already waits on the future, it runs to its end.
+            return job
+        if job.progress is not None and job.progress.started:
+            # Already searching, nobody can claim it anymore so it may stop early. Tasks are not cancelled here, a
+            # cancelled task would raise in whoever awaits it.
+            job.progress.stop()
+        elif job.future.cancel():
+            self.cancelled += 1
+        elif job.progress is not None:
+            job.progress.stop()
+        return job
+
+    def _expire(self, now: float):
+        # Entries are kept in order of their last touch, so expired ones are at the front. Referenced jobs still have a
+        # caller that will claim or release them and get the longer TTL.
+        for key, job in list(self._jobs.items()):
+            if job.expires > now:
+                break
+            if job.refs > 0 and job.expires - self.ttl + self.referenced_ttl > now:
+                continue
+            self._drop(key)
+            self.expired += 1
+
+    def _evict(self):
+        # Jobs somebody still waits for are never evicted, only the oldest unclaimed ones.
+        overflow = len(self._jobs) - self.max_jobs
+        if overflow <= 0:
+            return
+        unreferenced = [key for key, job in self._jobs.items() if job.refs <= 0]
+        for key in unreferenced[:overflow]:
+            self._drop(key)
+            self.evicted += 1
+
+    def submit(
+        self,
+        key: Hashable,
+        start: Callable[[], Future],
+        speculative: bool = False,
+        group: Hashable | None = None,
+        progress: Progress | None = None,
+    ) -> bool:
+        now = time.monotonic()
+        with self._lock:
+            self._expire(now)
+            job = self._jobs.get(key)
+            reused = job is not None and not job.future.cancelled()
+            if reused:
+                self.reused += 1
+            else:
+                job = self._jobs[key] = Job(start(), 0, now, progress=progress)
+            if group is not None:
+                job.groups.add(group)
+            if not speculative:
+                job.refs += 1
+            job.expires = now + self.ttl
+            self._jobs.move_to_end(key)
+            self._evict()
+            return reused
+
+    def get(self, key: Hashable) -> Job | None:
+        with self._lock:
+            return self._jobs.get(key)
+
+    def claim(self, key: Hashable) -> Future:
+        with self._lock:
+            job = self._jobs.get(key)
+            if job is None:
+                raise KeyError(key)
+            job.refs -= 1
+            if job.refs <= 0:
+                del self._jobs[key]
+            else:
+                job.claimed = True
+            return job.future
+
+    def release(self, key: Hashable) -> bool:
+        # Gives up a reference without claiming the result. The job is only dropped, and stopped if it already runs, once
+        # nobody else waits for it and no speculation holds on to it.
+        with self._lock:
+            job = self._jobs.get(key)
+            if job is None:
+                return False
+            job.refs -= 1
+            if job.refs > 0 or job.groups:
+                return False
+            self._drop(key)
+            return True
+
+    def cancel(self, key: Hashable) -> bool:
+        with self._lock:
+            if key not in self._jobs:
+                return False
+            return self._drop(key).future.cancelled()
+
+    def cancel_group(self, group: Hashable, keep: tuple[Hashable, ...] = ()) -> int:
+        # Drops the group's jobs nobody waits for, e.g. speculation made obsolete by the actual move. A job several groups
+        # speculated on stays until the last of them gives it up.
+        with self._lock:
+            keys = []
+            for key, job in self._jobs.items():
+                if group not in job.groups:
+                    continue
+                job.groups.discard(group)
+                if not job.groups and job.refs <= 0 and key not in keep:
+                    keys.append(key)
+            return sum(self._drop(key).future.cancelled() for key in keys)
+
+    def clear(self):
+        with self._lock:
+            for key in list(self._jobs):
+                self._drop(key)
+
+    def __contains__(self, key: Hashable) -> bool:
+        with self._lock:
+            return key in self._jobs
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._jobs)
+
+    def metrics(self) -> dict:
+        with self._lock:
+            return {
+                "jobs": len(self._jobs),
+                "referenced": sum(1 for job in self._jobs.values() if job.refs > 0),
+                "reused": self.reused,
+                "expired": self.expired,
+                "evicted": self.evicted,
+                "cancelled": self.cancelled,
+            }
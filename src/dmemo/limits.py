@@ -0,0 +1,70 @@
+from dataclasses import asdict
+from dataclasses import dataclass
+import os
+
+import chess.engine
+from dotenv import load_dotenv
+
+load_dotenv()
+
+ANALYSIS_MODES = ("time", "depth", "nodes", "adaptive")
+DEFAULT_DEPTH = 18
+DEFAULT_NODES = 1_000_000
+# Depth and node limits have no duration of their own, a slow engine or a deep request still stops after this many seconds.
+MAX_SEARCH_TIME = float(os.environ.get("MAX_SEARCH_TIME") or 30)
+# Adaptive searches stop once the best move and its score (within the margin) held for this many depths.
+STABLE_DEPTHS = 3
+STABLE_SCORE_MARGIN = 15
+STABLE_MIN_DEPTH = 8
+
+
+@dataclass(frozen=True)
+class AnalysisLimit:
+    time: float | None = None
+    depth: int | None = None
+    nodes: int | None = None
+    stable_depths: int | None = None
+
+    @classmethod
+    def of(cls, limit: "AnalysisLimit | float") -> "AnalysisLimit":
+        # Plain numbers are move times, as everywhere before limits existed.
+        return limit if isinstance(limit, cls) else cls(time=limit)
+
+    def engine_limit(self) -> chess.engine.Limit:
+        return chess.engine.Limit(time=self.time, depth=self.depth, nodes=self.nodes)
+
+    def key(self) -> str:
+        return ",".join(f"{name}={value}" for name, value in asdict(self).items() if value is not None)
+
+
+def make_limit(mode: str, move_time: float, depth: int | None = None, nodes: int | None = None) -> AnalysisLimit:
+    if mode == "depth":
+        return AnalysisLimit(time=MAX_SEARCH_TIME, depth=depth or DEFAULT_DEPTH)
+    if mode == "nodes":
+        return AnalysisLimit(time=MAX_SEARCH_TIME, nodes=nodes or DEFAULT_NODES)
+    if mode == "adaptive":
+        return AnalysisLimit(time=move_time, stable_depths=STABLE_DEPTHS)
+    return AnalysisLimit(time=move_time)
+
+
+class StabilityTracker:
+    def __init__(self, stable_depths: int):
+        self.stable_depths = stable_depths
+        self.depth = 0
+        self.best = None
+        self.streak = 0
+
+    def update(self, info: dict) -> bool:
+        # Fed with the principal line of every depth, true once the search can stop.
+        depth, pv, score = info.get("depth"), info.get("pv"), info.get("score")
+        if depth is None or not pv or score is None or depth <= self.depth:
+            return False
+        self.depth = depth
+
+        cp = score.relative.score(mate_score=100_000)
+        if self.best is not None and self.best[0] == pv[0] and abs(self.best[1] - cp) <= STABLE_SCORE_MARGIN:
+            self.streak += 1
+        else:
+            self.streak = 0
+        self.best = (pv[0], cp)
+        return depth >= STABLE_MIN_DEPTH and self.streak >= self.stable_depths
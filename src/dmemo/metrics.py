@@ -0,0 +1,166 @@
+from bisect import bisect_left
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass
+from dataclasses import field
+import os
+import threading
+import time
+from typing import Callable
+from typing import Iterable
+from typing import Iterator
+
+# Seconds, from a cache hit up to the longest move times.
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 90.0)
+# Requests slower than this many seconds are logged with their spans, unset disables the log.
+SLOW_REQUEST_SECONDS = float(os.environ.get("SLOW_REQUEST_SECONDS") or 0) or None
+
+Labels = tuple[tuple[str, str], ...]
+Gauge = tuple[str, dict, float]
+
+
+def format_labels(labels: Labels) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{name}="{value}"' for name, value in labels) + "}"
+
+
+class Histogram:
+    def __init__(self, name: str, help: str, buckets: tuple[float, ...] = LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.buckets = buckets
+        self._series: dict[Labels, list] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, **labels: str):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = [[0] * len(self.buckets), 0.0, 0]
+            index = bisect_left(self.buckets, value)
+            if index < len(self.buckets):
+                series[0][index] += 1
+            series[1] += value
+            series[2] += 1
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            for labels, (counts, total, count) in sorted(self._series.items()):
+                cumulative = 0
+                for bound, bucket_count in zip(self.buckets, counts):
+                    cumulative += bucket_count
+                    lines.append(f"{self.name}_bucket{format_labels(labels + (('le', str(bound)),))} {cumulative}")
+                lines.append(f"{self.name}_bucket{format_labels(labels + (('le', '+Inf'),))} {count}")
+                lines.append(f"{self.name}_sum{format_labels(labels)} {total}")
+                lines.append(f"{self.name}_count{format_labels(labels)} {count}")
+        return lines
+
+
+REQUEST_SECONDS = Histogram("dmemo_request_seconds", "Request latency by endpoint.")
+STAGE_SECONDS = Histogram("dmemo_stage_seconds", "Latency of the request stages and background steps.")
+HISTOGRAMS = [REQUEST_SECONDS, STAGE_SECONDS]
+
+_gauge_sources: dict[str, Callable[[], Iterable[Gauge]]] = {}
+
+
+def add_gauges(name: str, source: Callable[[], Iterable[Gauge]]):
+    # Sources are read on every scrape, e.g. the pool metrics of the running app.
+    _gauge_sources[name] = source
+
+
+def gauges(prefix: str, values: dict, **labels: str) -> Iterator[Gauge]:
+    # Numeric entries of a metrics() dict as gauges, nested dicts extend the name.
+    for name, value in values.items():
+        if isinstance(value, dict):
+            yield from gauges(f"{prefix}_{name}", value, **labels)
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            yield f"{prefix}_{name}", labels, value
+
+
+def render() -> str:
+    lines = []
+    for histogram in HISTOGRAMS:
+        lines.extend(histogram.render())
+    seen = set()
+    for source in _gauge_sources.values():
+        try:
+            values = list(source())
+        except Exception as e:
+            print(f"Collecting gauges failed: {e}")
+            continue
+        for name, labels, value in values:
+            if name not in seen:
+                seen.add(name)
+                lines.append(f"# TYPE {name} gauge")
+            lines.append(f"{name}{format_labels(tuple(sorted(labels.items())))} {value}")
+    return "\n".join(lines) + "\n"
+
+
+@dataclass
+class Trace:
+    name: str
+    start: float = field(default_factory=time.perf_counter)
+    spans: list[tuple[str, float, float]] = field(default_factory=list)
+
+    def breakdown(self) -> str:
+        return ", ".join(f"{name} +{offset * 1000:.1f}ms {duration * 1000:.1f}ms" for name, offset, duration in self.spans)
+
+
+_trace: ContextVar[Trace | None] = ContextVar("trace", default=None)
+
+
+def start_trace(name: str) -> Trace:
+    trace = Trace(name)
+    _trace.set(trace)
+    return trace
+
+
+def resume_trace(trace: Trace):
+    _trace.set(trace)
+
+
+def current_trace() -> Trace | None:
+    return _trace.get()
+
+
+def finish_trace(trace: Trace, endpoint: str):
+    # Streamed responses finish in another context, so the trace is passed in rather than read back.
+    _trace.set(None)
+    duration = time.perf_counter() - trace.start
+    REQUEST_SECONDS.observe(duration, endpoint=endpoint)
+    if SLOW_REQUEST_SECONDS is not None and duration >= SLOW_REQUEST_SECONDS:
+        print(f"🐢 Slow request {trace.name} took {duration * 1000:.1f}ms: {trace.breakdown() or 'no spans'}")
+
+
+def record_span(name: str, duration: float, start: float | None = None):
+    # Spans outside a request (worker threads, background tasks) only feed the histogram.
+    STAGE_SECONDS.observe(duration, stage=name)
+    trace = _trace.get()
+    if trace is not None:
+        start = start if start is not None else time.perf_counter() - duration
+        trace.spans.append((name, start - trace.start, duration))
+
+
+@contextmanager
+def shared_spans(traces: Iterable[Trace]):
+    # Work done once for several requests, e.g. a batched query, shows up in each of their traces.
+    collector = Trace("shared")
+    token = _trace.set(collector)
+    try:
+        yield
+    finally:
+        _trace.reset(token)
+        for trace in traces:
+            trace.spans.extend((name, collector.start + offset - trace.start, duration) for name, offset, duration in collector.spans)
+
+
+@contextmanager
+def span(name: str):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_span(name, time.perf_counter() - start, start)
@@ -0,0 +1,127 @@
+import argparse
+from collections import defaultdict
+import mmap
+import os
+import struct
+
+import chess
+from dotenv import load_dotenv
+import tqdm
+
+from dmemo.db.models import OpeningTree
+from dmemo.db.session import make_session
+from dmemo.utils import decode_move
+from dmemo.utils import encode_move
+from dmemo.utils import position_key
+from dmemo.utils import uci2board
+
+load_dotenv()
+
+MAGIC = b"DMBOOK01"
+# Polyglot-like fixed-size records sorted by position: zobrist key, move code, count.
+RECORD = struct.Struct(">qHI")
+KEY = struct.Struct(">q")
+MAX_COUNT = (1 << 32) - 1
+
+
+class OpeningBook:
+    def __init__(self, path: str):
+        self.path = path
+        with open(path, "rb") as f:
+            self.mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if self.mmap[: len(MAGIC)] != MAGIC:
+            self.mmap.close()
+            raise ValueError(f"{path} is not an opening book.")
+        self.size = (len(self.mmap) - len(MAGIC)) // RECORD.size
+
+    def _key_at(self, index: int) -> int:
+        return KEY.unpack_from(self.mmap, len(MAGIC) + index * RECORD.size)[0]
+
+    def _first(self, key: int) -> int:
+        lo, hi = 0, self.size
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._key_at(mid) < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def get(self, board: chess.Board) -> dict[str, int]:
+        key = position_key(board)
+        moves = {}
+        index = self._first(key)
+        while index < self.size:
+            record_key, code, count = RECORD.unpack_from(self.mmap, len(MAGIC) + index * RECORD.size)
+            if record_key != key:
+                break
+            moves[decode_move(code).uci()] = count
+            index += 1
+        return moves
+
+    def __contains__(self, board: chess.Board) -> bool:
+        index = self._first(position_key(board))
+        return index < self.size and self._key_at(index) == position_key(board)
+
+    def __len__(self) -> int:
+        return self.size
+
+    def close(self):
+        self.mmap.close()
+
+
+def write_book(path: str, counts: dict[tuple[int, int], int]):
+    # Records of one position are ordered by popularity so reads come back sorted like the DB queries.
+    records = sorted(counts.items(), key=lambda item: (item[0][0], -item[1]))
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(MAGIC)
+        for (key, code), count in records:
+            f.write(RECORD.pack(key, code, min(count, MAX_COUNT)))
+    os.replace(tmp_path, path)
+    print(f"✅ Wrote {len(records)} moves to {path}.")
+
+
+def add_distribution(counts: dict[tuple[int, int], int], board: chess.Board, moves: dict[str, int]):
+    key = position_key(board)
+    for move, count in moves.items():
+        counts[(key, encode_move(chess.Move.from_uci(move)))] += count
+
+
+def export_explorer_cache(explorer, depth: int) -> dict[tuple[int, int], int]:
+    counts = defaultdict(int)
+    # Transposed move orders share a cache entry when the explorer keys by position, count them once.
+    walk = explorer.walk_cache(depth, unique_positions=explorer.transpositions)
+    for uci, moves in tqdm.tqdm(walk, desc="📖 Exporting cache", unit="positions"):
+        add_distribution(counts, uci2board(uci), moves)
+    return counts
+
+
+def export_opening_tree() -> dict[tuple[int, int], int]:
+    counts = defaultdict(int)
+    with make_session() as session:
+        query = session.query(OpeningTree.parent, OpeningTree.move, OpeningTree.count).order_by(OpeningTree.parent)
+        board, parent = None, None
+        for row_parent, move, count in tqdm.tqdm(query.yield_per(50_000), desc="📖 Exporting tree", unit="rows"):
+            if row_parent != parent:
+                board, parent = uci2board(row_parent), row_parent
+            counts[(position_key(board), encode_move(chess.Move.from_uci(move)))] += count
+    return counts
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Compile the opening tree table into a memory-mapped opening book.",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    parser.add_argument(
+        "output",
+        nargs="?",
+        default=os.environ.get("EXPLORER_BOOK_PATH"),
+        help="Path of the book file.",
+    )
+    args = parser.parse_args()
+
+    if not args.output:
+        parser.error("Pass an output path or set EXPLORER_BOOK_PATH.")
+    write_book(args.output, export_opening_tree())
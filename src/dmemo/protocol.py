@@ -1,14 +1,25 @@
-import io
+import time
 from typing import Annotated
 from typing import Literal
+from typing import Optional
 
-import chess.pgn
 from pydantic import BaseModel
 from pydantic import Field
-from pydantic import field_validator
+from pydantic import PrivateAttr
+from pydantic import model_validator
 
+from dmemo.buckets import SPEEDS
+from dmemo.buckets import select_buckets
+from dmemo.limits import ANALYSIS_MODES
+from dmemo.limits import AnalysisLimit
+from dmemo.limits import make_limit
+from dmemo.metrics import record_span
+from dmemo.utils import Position
 
-class MoveRequest(BaseModel):
+UCI_MOVE = r"^[a-h][1-8][a-h][1-8][qrbn]?$"
+
+
+class SessionRequest(BaseModel):
     pgn: Annotated[
         str,
         Field(strict=True, description="PGN string representing the current game state"),
@@ -30,16 +41,82 @@ class MoveRequest(BaseModel):
         Literal["stockfish", "lczero"],
         Field(description="Type of chess engine to use"),
     ]
-    training_move: Annotated[
-        int,
-        Field(strict=True, ge=0, description="Current move number in the training session"),
+
+    rating_min: Annotated[
+        Optional[int],
+        Field(default=None, ge=0, description="Lower bound of the opponent rating band"),
+    ]
+    rating_max: Annotated[
+        Optional[int],
+        Field(default=None, ge=0, description="Upper bound (exclusive) of the opponent rating band"),
+    ]
+    speeds: Annotated[
+        Optional[list[Literal[SPEEDS]]],
+        Field(default=None, description="Speed classes of the opponent games, e.g. ['rapid']"),
     ]
 
-    @field_validator("pgn")
-    def validate_pgn(cls, v):
+    analysis_mode: Annotated[
+        Literal[ANALYSIS_MODES],
+        Field(default="time", description="Search limit: move time, fixed depth, fixed nodes or adaptive early stopping"),
+    ]
+    analysis_depth: Annotated[
+        Optional[int],
+        Field(default=None, ge=1, le=60, description="Search depth for the depth mode"),
+    ]
+    analysis_nodes: Annotated[
+        Optional[int],
+        Field(default=None, ge=1_000, le=1_000_000_000, description="Node count for the nodes mode"),
+    ]
+
+    @property
+    def analysis_limit(self) -> AnalysisLimit:
+        return make_limit(self.analysis_mode, self.move_time, self.analysis_depth, self.analysis_nodes)
+
+    @property
+    def buckets(self) -> tuple[int, ...] | None:
+        return select_buckets(self.rating_min, self.rating_max, self.speeds)
+
+    _position: Position = PrivateAttr()
+    _parse_time: float = PrivateAttr(default=0.0)
+
+    @model_validator(mode="after")
+    def parse_pgn(self):
+        # The game is parsed once here and the position is reused by the explorer and the evaluator.
+        start = time.perf_counter()
         try:
-            if chess.pgn.read_game(io.StringIO(v)) is None:
-                raise ValueError
+            self._position = Position.from_pgn(self.pgn)
         except Exception:
             raise ValueError("Invalid PGN string")
-        return v
+        self._parse_time = time.perf_counter() - start
+        record_span("parse_pgn", self._parse_time, start)
+        return self
+
+    @property
+    def position(self) -> Position:
+        return self._position
+
+    @property
+    def parse_time(self) -> float:
+        return self._parse_time
+
+
+class MoveRequest(SessionRequest):
+    training_move: Annotated[
+        int,
+        Field(strict=True, ge=0, description="Current move number in the training session"),
+    ]
+
+
+class SessionMoveRequest(BaseModel):
+    ply: Annotated[
+        int,
+        Field(strict=True, ge=0, description="Number of plies the client shares with the session"),
+    ]
+    moves: Annotated[
+        list[Annotated[str, Field(pattern=UCI_MOVE)]],
+        Field(default=[], max_length=64, description="UCI moves played after that ply"),
+    ]
+    training_move: Annotated[
+        int,
+        Field(strict=True, ge=0, description="Current move number in the training session"),
+    ]
@@ -0,0 +1,219 @@
+import argparse
+from multiprocessing.connection import Client
+from multiprocessing.connection import Listener
+import os
+import threading
+
+import chess
+from dotenv import load_dotenv
+
+from dmemo.engine import ChessAnalysisPool
+from dmemo.evalcache import EvalCache
+from dmemo.explorer import Explorer
+from dmemo.limits import AnalysisLimit
+
+load_dotenv()
+
+# Methods a client may call on the service side objects.
+POOL_METHODS = ("submit_job", "get_result", "progress", "cancel_job", "release_job", "cancel_group", "submit_and_get", "metrics")
+EXPLORER_METHODS = ("submit_job", "get_result", "submit_and_get", "metrics")
+
+
+def parse_address(address: str) -> str | tuple[str, int]:
+    # "unix:/run/dmemo.sock" for a local socket, "host:port" for TCP.
+    if address.startswith("unix:"):
+        return address[len("unix:") :]
+    host, port = address.rsplit(":", 1)
+    return host, int(port)
+
+
+def service_authkey() -> bytes | None:
+    authkey = os.environ.get("ANALYSIS_SERVICE_AUTHKEY")
+    return authkey.encode() if authkey else None
+
+
+class AnalysisService:
+    def __init__(self, address: str, pool: ChessAnalysisPool, explorer: Explorer, authkey: bytes | None = None):
+        self.address = parse_address(address)
+        # Connections unpickle whatever they receive, so a TCP listener must authenticate its clients.
+        if not isinstance(self.address, str) and not authkey:
+            raise ValueError("A TCP analysis service needs ANALYSIS_SERVICE_AUTHKEY, or listen on a unix: socket.")
+        self.targets = {"pool": (pool, POOL_METHODS), "explorer": (explorer, EXPLORER_METHODS)}
+        if isinstance(self.address, str) and os.path.exists(self.address):
+            os.unlink(self.address)
+        self.listener = Listener(self.address, authkey=authkey)
+
+    def _handle(self, conn):
+        with conn:
+            while True:
+                try:
+                    target, method, args, kwargs = conn.recv()
+                except (EOFError, OSError):
+                    return
+
+                obj, methods = self.targets[target]
+                try:
+                    if method not in methods:
+                        raise AttributeError(f"{target}.{method} is not exposed by the analysis service.")
+                    response = ("ok", getattr(obj, method)(*args, **kwargs))
+                except Exception as e:
+                    response = ("error", e)
+                conn.send(response)
+
+    def serve_forever(self):
+        print(f"🛰️ Analysis service listening on {self.listener.address}.")
+        while True:
+            try:
+                conn = self.listener.accept()
+            except OSError:
+                return
+            threading.Thread(target=self._handle, args=(conn,), daemon=True).start()
+
+    def close(self):
+        self.listener.close()
+        for obj, _ in self.targets.values():
+            obj.shutdown()
+
+
+class RemoteClient:
+    # One connection per thread, so concurrent requests of a Flask worker don't interleave on a socket.
+    def __init__(self, address: str, target: str, authkey: bytes | None = None):
+        self.address = parse_address(address)
+        self.target = target
+        self.authkey = authkey
+        self._local = threading.local()
+
+    def _connection(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = self._local.conn = Client(self.address, authkey=self.authkey)
+        return conn
+
+    def _call(self, method: str, *args, **kwargs):
+        conn = self._connection()
+        try:
+            conn.send((self.target, method, args, kwargs))
+            status, value = conn.recv()
+        except (EOFError, OSError):
+            self._local.conn = None
+            raise
+        if status == "error":
+            raise value
+        return value
+
+    def shutdown(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is not None:
+            conn.close()
+            self._local.conn = None
+
+
+class RemoteAnalysisPool(RemoteClient):
+    def __init__(self, address: str, authkey: bytes | None = None):
+        super().__init__(address, "pool", authkey)
+
+    @staticmethod
+    def job_id(uci: str, engine_type: str, multi_pv: int, root_moves: list[str] | None = None, limit: AnalysisLimit | float | None = None):
+        return ChessAnalysisPool.job_id(uci, engine_type, multi_pv, root_moves, limit)
+
+    def submit_job(
+        self,
+        uci: str,
+        engine_type: str,
+        limit: AnalysisLimit | float,
+        multi_pv: int,
+        speculative: bool = False,
+        root_moves: list[str] | None = None,
+        group: str | None = None,
+        board: chess.Board | None = None,
+    ) -> str:
+        return self._call("submit_job", uci, engine_type, limit, multi_pv, speculative, root_moves, group, board)
+
+    def get_result(self, id: str) -> list[dict]:
+        return self._call("get_result", id)
+
+    def progress(self, id: str, after: int = 0, timeout: float = 1.0) -> tuple[int, list[dict] | None, bool]:
+        return self._call("progress", id, after, timeout)
+
+    def cancel_job(self, id: str) -> bool:
+        return self._call("cancel_job", id)
+
+    def release_job(self, id: str) -> bool:
+        return self._call("release_job", id)
+
+    def cancel_group(self, group: str, keep: tuple[str, ...] = ()) -> int:
+        return self._call("cancel_group", group, keep)
+
+    def submit_and_get(self, uci: str, engine_type: str, limit: AnalysisLimit | float, multi_pv: int) -> list[dict]:
+        return self._call("submit_and_get", uci, engine_type, limit, multi_pv)
+
+    def metrics(self) -> dict[str, dict]:
+        return self._call("metrics")
+
+
+class RemoteExplorer(RemoteClient):
+    def __init__(self, address: str, authkey: bytes | None = None):
+        super().__init__(address, "explorer", authkey)
+
+    def submit_job(
+        self,
+        uci: str,
+        buckets: tuple[int, ...] | None = None,
+        speculative: bool = False,
+        board: chess.Board | None = None,
+    ) -> None:
+        self._call("submit_job", uci, buckets, speculative, board)
+
+    def get_result(self, uci: str, buckets: tuple[int, ...] | None = None) -> dict[str, int]:
+        return self._call("get_result", uci, buckets)
+
+    def submit_and_get(self, uci: str, buckets: tuple[int, ...] | None = None, board: chess.Board | None = None) -> dict[str, int]:
+        return self._call("submit_and_get", uci, buckets, board)
+
+    def metrics(self) -> dict:
+        return self._call("metrics")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Standalone analysis service shared by all web workers on a host.",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    parser.add_argument(
+        "--address",
+        default=os.environ.get("ANALYSIS_SERVICE_ADDRESS") or "unix:/tmp/dmemo-analysis.sock",
+        help="unix:<path> or <host>:<port> to listen on.",
+    )
+    parser.add_argument(
+        "--num-workers",
+        type=int,
+        default=6,
+        help="Number of concurrent engines per engine type on this host.",
+    )
+    parser.add_argument(
+        "--explorer-workers",
+        type=int,
+        default=4,
+        help="Number of explorer database workers.",
+    )
+    args = parser.parse_args()
+    if not args.address.startswith("unix:") and service_authkey() is None:
+        parser.error("Listening on TCP requires ANALYSIS_SERVICE_AUTHKEY, use a unix: address otherwise.")
+
+    pool = ChessAnalysisPool(
+        num_workers=args.num_workers,
+        eval_cache=EvalCache(os.environ.get("EVAL_CACHE_PATH")),
+    )
+    explorer = Explorer(
+        os.environ.get("EXPLORER_CACHE_PATH"),
+        num_workers=args.explorer_workers,
+        transpositions=os.environ.get("EXPLORER_TRANSPOSITIONS") == "1",
+        book_path=os.environ.get("EXPLORER_BOOK_PATH"),
+    )
+    service = AnalysisService(args.address, pool, explorer, authkey=service_authkey())
+    try:
+        service.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        service.close()
@@ -0,0 +1,105 @@
+from collections import OrderedDict
+from dataclasses import dataclass
+import threading
+import time
+import uuid
+import weakref
+
+import diskcache as dc
+
+from dmemo.limits import AnalysisLimit
+from dmemo.utils import Position
+
+# A worker that died holding a session lock stops blocking the session after this many seconds.
+SESSION_LOCK_SECONDS = 300.0
+
+
+class SessionConflict(Exception):
+    pass
+
+
+@dataclass
+class TrainingSession:
+    position: Position
+    orientation: str
+    engine_type: str
+    move_time: float
+    buckets: tuple[int, ...] | None = None
+    limit: AnalysisLimit | None = None
+
+    def advance(self, ply: int, moves: list[str]):
+        # The client sends the ply it shares with the session and what it played since. Anything past that ply was taken
+        # back on the client (restarted round, hint), so the board is rewound before the new moves are pushed.
+        known = len(self.position.moves)
+        if ply > known:
+            raise SessionConflict(f"Session is at ply {known}, got moves from ply {ply}")
+        board = self.position.board.copy()
+        for _ in range(known - ply):
+            board.pop()
+        for move in moves:
+            board.push_uci(move)
+        self.position = Position(board, self.position.moves[:ply] + moves)
+
+
+class SessionStore:
+    # Sessions live in memory, or in a disk cache when several worker processes have to share them.
+    def __init__(self, cache_path: str | None = None, ttl: float = 1800.0, max_sessions: int = 10_000):
+        self.ttl = ttl
+        self.max_sessions = max_sessions
+        self.disk = dc.Cache(cache_path) if cache_path else None
+        self._sessions: OrderedDict[str, tuple[TrainingSession, float]] = OrderedDict()
+        self._session_locks: weakref.WeakValueDictionary[str, threading.Lock] = weakref.WeakValueDictionary()
+        self._lock = threading.Lock()
+
+    def _expire(self, now: float):
+        while self._sessions:
+            session_id, (_, expires) = next(iter(self._sessions.items()))
+            if expires > now and len(self._sessions) <= self.max_sessions:
+                break
+            del self._sessions[session_id]
+
+    def lock(self, session_id: str) -> threading.Lock | dc.Lock:
+        # Turns of one session are applied one after another, in a shared store across all worker processes.
+        if self.disk is not None:
+            return dc.Lock(self.disk, f"lock:{session_id}", expire=SESSION_LOCK_SECONDS)
+        with self._lock:
+            lock = self._session_locks.get(session_id)
+            if lock is None:
+                lock = self._session_locks[session_id] = threading.Lock()
+            return lock
+
+    def create(self, session: TrainingSession) -> str:
+        session_id = uuid.uuid4().hex
+        self.save(session_id, session)
+        return session_id
+
+    def get(self, session_id: str) -> TrainingSession | None:
+        if self.disk is not None:
+            return self.disk.get(session_id)
+        with self._lock:
+            self._expire(time.monotonic())
+            entry = self._sessions.get(session_id)
+            return entry[0] if entry is not None else None
+
+    def save(self, session_id: str, session: TrainingSession):
+        if self.disk is not None:
+            self.disk.set(session_id, session, expire=self.ttl)
+            return
+        with self._lock:
+            now = time.monotonic()
+            self._sessions[session_id] = (session, now + self.ttl)
+            self._sessions.move_to_end(session_id)
+            self._expire(now)
+
+    def delete(self, session_id: str) -> TrainingSession | None:
+        if self.disk is not None:
+            return self.disk.pop(session_id, None)
+        with self._lock:
+            entry = self._sessions.pop(session_id, None)
+            return entry[0] if entry is not None else None
+
+    def __len__(self) -> int:
+        if self.disk is not None:
+            return len(self.disk)
+        with self._lock:
+            return len(self._sessions)
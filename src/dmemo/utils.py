@@ -1,9 +1,12 @@
+from dataclasses import dataclass
 import io
 import random
+import struct
 from typing import Tuple
 
 import chess
 import chess.pgn
+import chess.polyglot
 
 
 def pgn2game(pgn: str) -> chess.pgn.Game:
@@ -17,7 +20,7 @@ def pgn2board(pgn: str) -> chess.Board:
 
 
 def game2pgn(game: chess.pgn.Game) -> str:
-    exporter = chess.pgn.StringExporter(headers=False, variations=False, comments=False)
+    exporter = chess.pgn.StringExporter(columns=None, headers=False, variations=False, comments=False)
     pgn_string = game.accept(exporter)
     return pgn_string.rsplit(" ", 1)[0].strip()
 
@@ -34,6 +37,30 @@ def pgn2uci(pgn: str) -> str:
     return game2uci(game)
 
 
+@dataclass
+class Position:
+    # A game parsed once per request: the final board and its moves, shared by every later step.
+    board: chess.Board
+    moves: list[str]
+
+    @classmethod
+    def from_pgn(cls, pgn: str) -> "Position":
+        game = pgn2game(pgn)
+        if game is None:
+            raise ValueError("Invalid PGN string")
+        board = game.end().board()
+        return cls(board, [move.uci() for move in board.move_stack])
+
+    @property
+    def uci(self) -> str:
+        return " ".join(self.moves)
+
+    def push(self, move: str) -> "Position":
+        board = self.board.copy()
+        board.push_uci(move)
+        return Position(board, self.moves + [move])
+
+
 def uci2board(uci_moves: str) -> chess.Board:
     board = chess.Board()
     if uci_moves:
@@ -42,6 +69,31 @@ def uci2board(uci_moves: str) -> chess.Board:
     return board
 
 
+def encode_move(move: chess.Move) -> int:
+    # Polyglot-style 16-bit code: to (6 bits) | from (6 bits) | promotion piece type (3 bits).
+    return move.to_square | move.from_square << 6 | (move.promotion or 0) << 12
+
+
+def decode_move(code: int) -> chess.Move:
+    return chess.Move(code >> 6 & 63, code & 63, code >> 12 or None)
+
+
+def encode_moves(uci_moves: str) -> bytes:
+    codes = [encode_move(chess.Move.from_uci(move)) for move in uci_moves.split()]
+    return struct.pack(f">{len(codes)}H", *codes)
+
+
+def decode_moves(data: bytes) -> str:
+    codes = struct.unpack(f">{len(data) // 2}H", data)
+    return " ".join(decode_move(code).uci() for code in codes)
+
+
+def position_key(board: chess.Board) -> int:
+    # Zobrist hashes are unsigned 64-bit, Postgres BIGINT is signed.
+    key = chess.polyglot.zobrist_hash(board)
+    return key - (1 << 64) if key >= (1 << 63) else key
+
+
 def sample_move(distribution: dict[str, int], threshold: float = 0.05) -> str | None:
     if not distribution:
         return None